@@ -1,33 +1,52 @@
+import atexit
 import sys
+from threading import Lock
 
-import cv2
-from flask import Flask, render_template, Response
-from camera import VideoCap
+from flask import Flask, render_template, Response, abort
+from metrics import metrics
+# the capture stack (cv2, camera, tracker, encoder) is imported on first use, supervisor.py serves its cameras
+# through this app without it
 
 app = Flask(__name__)
 cam = None  # VideoCap(0, refresh_timeout=500) #video_path='media/vi_0000_20220725_122016.mp4', refresh_timeout=500)
+hub = None
+hub_lock = Lock()
+stream_width = 640
+stream_quality = 80
+supervisor = None  # supervisor.CameraSupervisor when serving several cameras, see supervisor.py
+# stream type to the VideoCap method producing its frames
+PRODUCERS = {"index": "get_frame",
+             "track": "get_orb_tracking",
+             "backgroundsubtraction": "get_background"}
 
 
-def camera_frame(camera, video_type: str = "index"):
+def get_hub():
     """
-    Returns a camera frame.
-    :param camera:
+    Returns the frame hub of the shared camera, creating both on first use.
+    :return:
+    """
+    global cam, hub
+    with hub_lock:
+        if hub is None:
+            from camera import VideoCap
+            from encoder import StreamEncoder
+            from hub import FrameHub
+            cam = VideoCap(0, refresh_timeout=500, is_direct=True) if cam is None else cam
+            producers = {video_type: getattr(VideoCap, name) for video_type, name in PRODUCERS.items()}
+            hub = FrameHub(cam, producers, lambda: StreamEncoder(stream_quality, stream_width or None))
+    return hub
+
+
+def camera_frame(video_type: str = "index"):
+    """
+    Returns the camera frames of a stream type as multipart JPEG parts. The frames come from the shared hub,
+    so every viewer gets the latest frame without capturing or encoding it again. The camera returns raw frames,
+    the hub encodes them at the stream width and quality off the processing thread.
     :param video_type:
     :return:
     """
-    camera = VideoCap(0, refresh_timeout=500) if camera is None else camera
-    while True:
-        if video_type == "index":
-            frame = camera.get_frame()
-        elif video_type == "track":
-            frame = camera.get_orb_tracking()
-        elif video_type == "backgroundsubtraction":
-            frame = camera.get_background()
-        else:
-            frame = None
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame +
-               b'\r\n\r\n')
+    from encoder import multipart_frames
+    return multipart_frames(get_hub().stream(video_type))
 
 
 @app.route('/')
@@ -50,7 +69,23 @@ def track():
 
 @app.route('/video/<string:video_type>')
 def video(video_type: str = "index"):
-    return Response(camera_frame(cam, video_type), mimetype='multipart/x-mixed-replace; boundary=frame')
+    if video_type not in PRODUCERS:
+        abort(404)
+    return Response(camera_frame(video_type), mimetype='multipart/x-mixed-replace; boundary=frame')
+
+
+@app.route('/video/<string:camera_id>/<string:video_type>')
+def camera_video(camera_id: str, video_type: str):
+    if supervisor is None or (camera_id, video_type) not in supervisor.rings:
+        abort(404)
+    from encoder import multipart_frames
+    return Response(multipart_frames(supervisor.stream(camera_id, video_type)),
+                    mimetype='multipart/x-mixed-replace; boundary=frame')
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.prometheus(), mimetype='text/plain; version=0.0.4')
 
 
 if __name__ == "__main__":
@@ -58,5 +93,14 @@ if __name__ == "__main__":
     refresh_timeout = int(sys.argv[1]) if len(sys.argv) > 1 else 500
     height = int(sys.argv[2]) if len(sys.argv) > 2 else 720
     width = int(sys.argv[3]) if len(sys.argv) > 3 else 1280
-    cam = VideoCap(0, refresh_timeout=refresh_timeout, is_direct=False, height=height, width=width)
+    prefetch = int(sys.argv[4]) if len(sys.argv) > 4 else 2
+    target_fps = float(sys.argv[5]) if len(sys.argv) > 5 else 15
+    stream_width = int(sys.argv[6]) if len(sys.argv) > 6 else 640  # 0 streams at the capture resolution
+    stream_quality = int(sys.argv[7]) if len(sys.argv) > 7 else 80
+    motion_model = int(sys.argv[8]) > 0 if len(sys.argv) > 8 else False
+    from camera import VideoCap
+    from scheduler import AdaptiveScheduler
+    cam = VideoCap(0, refresh_timeout=refresh_timeout, is_direct=True, height=height, width=width, prefetch=prefetch,
+                   scheduler=AdaptiveScheduler(target_fps) if target_fps > 0 else None, motion_model=motion_model)
+    atexit.register(cam.release)
     app.run(debug=False, host='0.0.0.0')
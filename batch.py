@@ -0,0 +1,215 @@
+import argparse
+import json
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from orb_detector import ORBTracker
+from sink import open_sink
+
+
+def _open_at(video_path: str, frame: int):
+    """
+    Opens a video positioned at the given frame. Containers that can't seek reliably, e.g. raw raspivid .h264
+    streams, are positioned by grabbing the preceding frames.
+    :param video_path:
+    :param frame: 0 based index of the first frame to read.
+    :return:
+    """
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise Exception(f"Could not open video {video_path}")
+    if frame > 0 and not (cap.set(cv2.CAP_PROP_POS_FRAMES, frame) and int(cap.get(cv2.CAP_PROP_POS_FRAMES)) == frame):
+        cap.release()
+        cap = cv2.VideoCapture(video_path)
+        for _ in range(frame):
+            if not cap.grab():
+                break
+    return cap
+
+
+def process_chunk(video_path: str, start_frame: int = 0, stop_frame: int = None, warmup: int = 0,
+                  tracker_kwargs: dict = None):
+    """
+    Tracks the frames [start_frame, stop_frame) of a video. The warmup frames before start_frame are tracked too so
+    the MOG2 background has converged at start_frame, their rows are returned for stitching the chunks.
+    :param video_path:
+    :param start_frame: 0 based index of the first frame of the chunk.
+    :param stop_frame: index after the last frame, None tracks until the end of the video.
+    :param warmup: number of frames tracked before start_frame.
+    :param tracker_kwargs: arguments of the ORBTracker, the heatmap_size is 10 as in the live app unless given.
+    :return: dictionary with the chunk range, the frame size and an (N, 6) array of frame, track id, x, y, w, h
+        in pixels with 1 based frame numbers
+    """
+    first = max(start_frame - warmup, 0)
+    cap = _open_at(video_path, first)
+    tracker = ORBTracker(**dict({"heatmap_size": 10}, **(tracker_kwargs or {})))
+    rows, height, width = [], 0, 0
+    frame_index = first
+    while stop_frame is None or frame_index < stop_frame:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        height, width = frame.shape[:2]
+        tracker.track(frame)
+        detections = np.asarray(tracker.get_detections(), float).reshape(-1, 4)
+        if len(detections):
+            rows.append(np.column_stack([np.full(len(detections), frame_index + 1), tracker.get_detection_ids(),
+                                         detections]))
+        frame_index += 1
+    cap.release()
+    return {"video": video_path, "start_frame": start_frame, "stop_frame": frame_index, "width": width,
+            "height": height, "rows": np.concatenate(rows) if rows else np.empty((0, 6))}
+
+
+def _match_ids(previous, current, max_distance: float):
+    """
+    Maps the track ids of a chunk to the ids of the previous chunk using the frames both of them tracked.
+    Detections of the same frame closer than max_distance vote for an id pair, pairs are taken by decreasing
+    number of votes so every id is mapped at most once.
+    :param previous: rows of the previous chunk in the overlap.
+    :param current: rows of the current chunk in the overlap.
+    :param max_distance: maximum distance between two detections of the same bee.
+    :return: dictionary of current id to previous id
+    """
+    votes = Counter()
+    for frame in np.intersect1d(previous[:, 0], current[:, 0]):
+        p, c = previous[previous[:, 0] == frame], current[current[:, 0] == frame]
+        distances = np.linalg.norm(p[:, None, 2:4] - c[None, :, 2:4], axis=2)
+        for i, j in zip(*np.nonzero(distances < max_distance)):
+            votes[int(c[j, 1]), int(p[i, 1])] += 1
+    mapping, used = {}, set()
+    for (current_id, previous_id), _ in votes.most_common():
+        if current_id not in mapping and previous_id not in used:
+            mapping[current_id] = previous_id
+            used.add(previous_id)
+    return mapping
+
+
+def stitch_chunks(chunks, max_distance: float = 10):
+    """
+    Merges the chunks of one video into one table with track ids that are unique over the whole video.
+    Tracks crossing a chunk boundary keep the id they had in the previous chunk.
+    :param chunks: results of process_chunk sorted by start_frame.
+    :param max_distance: maximum distance between two detections of the same bee in the overlap.
+    :return: (N, 6) array of frame, track id, x, y, w, h
+    """
+    merged, previous, next_id = [], None, 0
+    for chunk in chunks:
+        rows = chunk["rows"].copy()
+        start = chunk["start_frame"] + 1
+        mapping = {}
+        if previous is not None:
+            overlap = rows[rows[:, 0] < start]
+            mapping = _match_ids(previous[previous[:, 0] >= overlap[:, 0].min()] if len(overlap) else previous[:0],
+                                 overlap, max_distance)
+        rows = rows[rows[:, 0] >= start]
+        ids = rows[:, 1].astype(np.int64)
+        unique_ids = np.unique(ids)
+        new_ids = [i for i in unique_ids if int(i) not in mapping]
+        mapping.update({int(i): next_id + k for k, i in enumerate(new_ids)})
+        next_id += len(new_ids)
+        rows[:, 1] = [mapping[int(i)] for i in ids]
+        merged.append(rows)
+        previous = rows
+    return np.concatenate(merged) if merged else np.empty((0, 6))
+
+
+def _chunk_ranges(video_path: str, chunk_frames: int):
+    """
+    Splits a video into frame ranges of chunk_frames frames, the whole video when it can't be split.
+    :param video_path:
+    :param chunk_frames:
+    :return: list of start, stop frame pairs
+    """
+    if chunk_frames <= 0:
+        return [(0, None)]
+    cap = cv2.VideoCapture(video_path)
+    n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    if n_frames <= chunk_frames:
+        # unknown length (raw .h264) or a short video
+        return [(0, None)]
+    ranges = [(start, start + chunk_frames) for start in range(0, n_frames, chunk_frames)]
+    # the frame count of a container is an estimate, the last chunk reads until the video ends
+    ranges[-1] = (ranges[-1][0], None)
+    return ranges
+
+
+def _output_names(video_paths):
+    """
+    Names the detection files after the videos. Videos with the same file name in different directories, e.g.
+    a/cam.mp4 and b/cam.mp4, are named after their path below the common directory instead, a_cam and b_cam.
+    :param video_paths:
+    :return: list of names, in the order of video_paths
+    """
+    if len(set(map(os.path.abspath, video_paths))) < len(video_paths):
+        raise ValueError("a video is given more than once")
+    names = [os.path.splitext(os.path.basename(path))[0] for path in video_paths]
+    counts = Counter(names)
+    stem_counts = Counter(os.path.splitext(os.path.abspath(path))[0] for path in video_paths)
+    common = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in video_paths])
+    for i, path in enumerate(video_paths):
+        if counts[names[i]] > 1:
+            relative = os.path.relpath(os.path.abspath(path), common)
+            stem = os.path.splitext(relative)[0]
+            # cam.mp4 and cam.h264 of one directory keep their extension
+            names[i] = (stem if stem_counts[os.path.join(common, stem)] == 1 else relative).replace(os.sep, "_")
+    return names
+
+
+def batch_process(video_paths, output_dir: str = "results", output_format: str = "npy", workers: int = None,
+                  chunk_frames: int = 0, warmup: int = 100, tracker_kwargs: dict = None):
+    """
+    Tracks many videos on a process pool. Videos longer than chunk_frames are split into chunks which are tracked
+    in parallel with warmup frames of overlap and stitched back together. The detections of every video are
+    written to output_dir in the given format, named after the video, see _output_names.
+    :param video_paths: list of videos.
+    :param output_dir: directory of the detection files.
+    :param output_format: csv or npy, see sink.open_sink.
+    :param workers: number of processes, None uses every core.
+    :param chunk_frames: number of frames per chunk, 0 tracks every video in one piece.
+    :param warmup: number of frames tracked before a chunk for the background model and stitching.
+    :param tracker_kwargs: arguments of the ORBTracker, see process_chunk.
+    :return: dictionary of video to output path
+    """
+    names = dict(zip(video_paths, _output_names(video_paths)))
+    os.makedirs(output_dir, exist_ok=True)
+    outputs = {}
+    with ProcessPoolExecutor(workers) as executor:
+        futures = {video_path: [executor.submit(process_chunk, video_path, start, stop, warmup if start else 0,
+                                                tracker_kwargs)
+                                for start, stop in _chunk_ranges(video_path, chunk_frames)]
+                   for video_path in video_paths}
+        for video_path, chunk_futures in futures.items():
+            chunks = [future.result() for future in chunk_futures]
+            rows = stitch_chunks(chunks)
+            width, height = chunks[0]["width"], chunks[0]["height"]
+            path = os.path.join(output_dir, names[video_path] + (".csv" if output_format == "csv" else ""))
+            with open_sink(path, output_format) as sink:
+                frames = rows[:, 0].astype(np.int64)
+                bounds = np.concatenate([[0], np.flatnonzero(np.diff(frames)) + 1, [len(frames)]])
+                for lo, hi in zip(bounds[:-1], bounds[1:]):
+                    sink.write(int(frames[lo]), rows[lo:hi, 2:6] / [width, height, width, height],
+                               rows[lo:hi, 1].astype(np.int64))
+            outputs[video_path] = path
+            print(f"{video_path}: {len(rows)} detections in {len(chunks)} chunks -> {path}")
+    return outputs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Track recorded videos in parallel.")
+    parser.add_argument("videos", nargs="+")
+    parser.add_argument("--output-dir", default="results")
+    parser.add_argument("--format", default="npy", choices=["csv", "npy"])
+    parser.add_argument("--workers", type=int, default=None, help="number of processes, every core by default")
+    parser.add_argument("--chunk-frames", type=int, default=0, help="split longer videos into chunks")
+    parser.add_argument("--warmup", type=int, default=100, help="overlap frames before every chunk")
+    parser.add_argument("--tracker-kwargs", type=json.loads, default=None,
+                        help='JSON object of ORBTracker arguments, e.g. {"heatmap_size": 20, "min_track_length": 5}')
+    args = parser.parse_args()
+    batch_process(args.videos, args.output_dir, args.format, args.workers, args.chunk_frames, args.warmup,
+                  args.tracker_kwargs)
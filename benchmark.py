@@ -0,0 +1,308 @@
+import argparse
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from encoder import StreamEncoder
+from orb_detector import ORBDetector, ORBTracker, keypoint_heatmap
+from track import HungarianTracker
+
+
+def legacy_heatmap(points, shape, heatmap_size: int, min_hits: int):
+    """
+    The original per-keypoint heatmap loop of ORBDetector._create_heatmap, kept as the benchmark baseline.
+    :param points: (N, 2) array of keypoint x, y coordinates.
+    :param shape: shape of the frame.
+    :param heatmap_size: half size of the window each keypoint votes for.
+    :param min_hits: minimum number of votes for a pixel to be kept.
+    :return:
+    """
+    heatmap = np.zeros(shape[:2], np.uint8)
+    for px, py in points:
+        x, y = int(px), int(py)
+        heatmap[y - heatmap_size:y + heatmap_size, x - heatmap_size:x + heatmap_size] += 1
+    heatmap[heatmap < min_hits] = 0
+    return heatmap
+
+
+def _time_call(func, repeats: int, *args):
+    """
+    Times repeated calls of func and returns the per call latencies in milliseconds.
+    :param func:
+    :param repeats:
+    :param args:
+    :return:
+    """
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(*args)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return np.array(latencies)
+
+
+def bench_heatmap(n_keypoints: int = 500, height: int = 720, width: int = 1280, heatmap_size: int = 10,
+                  min_hits: int = 3, repeats: int = 50, seed: int = 0):
+    """
+    Compares the vectorized keypoint heatmap against the legacy per-keypoint loop.
+    Keypoints are kept away from the frame border so both implementations must agree exactly.
+    :return: dictionary with the latencies of both implementations.
+    """
+    rng = np.random.default_rng(seed)
+    points = np.column_stack([rng.uniform(heatmap_size, width - heatmap_size, n_keypoints),
+                              rng.uniform(heatmap_size, height - heatmap_size, n_keypoints)]).astype(np.float32)
+    shape = (height, width)
+    legacy = legacy_heatmap(points, shape, heatmap_size, min_hits)
+    vectorized = keypoint_heatmap(points, shape, heatmap_size, min_hits)
+    result = {"benchmark": "heatmap", "n_keypoints": n_keypoints, "resolution": [width, height],
+              "heatmap_size": heatmap_size, "min_hits": min_hits,
+              "outputs_match": bool(np.array_equal(legacy, vectorized))}
+    for name, func in (("legacy", legacy_heatmap), ("vectorized", keypoint_heatmap)):
+        latencies = _time_call(func, repeats, points, shape, heatmap_size, min_hits)
+        result[name] = {"mean_ms": float(latencies.mean()), "p50_ms": float(np.percentile(latencies, 50)),
+                        "p95_ms": float(np.percentile(latencies, 95))}
+    result["speedup"] = result["legacy"]["mean_ms"] / result["vectorized"]["mean_ms"]
+    return result
+
+
+class SyntheticScene:
+    def __init__(self, n_bees: int = 20, speed: float = 5.0, height: int = 720, width: int = 1280, bee_size: int = 12,
+                 seed: int = 0):
+        """
+        Creates a SyntheticScene object, a deterministic stand-in for a hive entrance recording. The background is
+        smoothed noise with some texture for ORB, the bees are banded ellipses moving at a constant speed in a
+        random direction and bouncing off the frame borders.
+        :param n_bees: number of bees in view.
+        :param speed: speed of the bees in pixels per frame.
+        :param height: frame height.
+        :param width: frame width.
+        :param bee_size: major half axis of a bee in pixels.
+        :param seed: seed of the scene, the same seed gives the same frames.
+        """
+        rng = np.random.default_rng(seed)
+        self.height, self.width, self.bee_size = height, width, bee_size
+        noise = rng.integers(0, 256, (height // 8 + 1, width // 8 + 1, 3), dtype=np.uint8)
+        self.background = cv2.GaussianBlur(cv2.resize(noise, (width, height), interpolation=cv2.INTER_LINEAR), (5, 5), 0)
+        self.positions = rng.uniform([bee_size, bee_size], [width - bee_size, height - bee_size], (n_bees, 2))
+        angles = rng.uniform(0, 2 * np.pi, n_bees)
+        self.velocities = speed * np.column_stack([np.cos(angles), np.sin(angles)])
+        # dark and light bands across the body, coarse enough to survive a downscaled processing resolution
+        bands = (np.arange(2 * bee_size) // 3 % 2).astype(bool)[None, :, None]
+        dark, light = rng.integers(10, 50, (n_bees, 1, 1, 3)), rng.integers(120, 220, (n_bees, 1, 1, 3))
+        self.textures = np.broadcast_to(np.where(bands, light, dark), (n_bees, 2 * bee_size, 2 * bee_size, 3))
+        self.textures = np.ascontiguousarray(self.textures, dtype=np.uint8)
+
+    def frames(self, n_frames: int):
+        """
+        Renders the next n_frames frames.
+        :param n_frames:
+        :return: generator of BGR frames
+        """
+        size = self.bee_size
+        mask = np.zeros((2 * size, 2 * size), np.uint8)
+        cv2.ellipse(mask, (size, size), (size - 1, size // 2), 0, 0, 360, 255, -1)
+        for _ in range(n_frames):
+            frame = self.background.copy()
+            for (x, y), texture in zip(self.positions.astype(int), self.textures):
+                roi = frame[y - size:y + size, x - size:x + size]
+                cv2.copyTo(texture, mask, roi)
+            yield frame
+            self.positions += self.velocities
+            low, high = [size, size], [self.width - size - 1, self.height - size - 1]
+            bounced = (self.positions < low) | (self.positions > high)
+            self.velocities[bounced] *= -1
+            self.positions = np.clip(self.positions, low, high)
+
+
+def _summary(latencies):
+    """
+    Summarises per frame latencies in milliseconds.
+    :param latencies:
+    :return:
+    """
+    latencies = np.asarray(latencies)
+    return {"mean_ms": float(latencies.mean()), "p50_ms": float(np.percentile(latencies, 50)),
+            "p90_ms": float(np.percentile(latencies, 90)), "p99_ms": float(np.percentile(latencies, 99)),
+            "max_ms": float(latencies.max()), "fps": float(1000 / latencies.mean())}
+
+
+def _traced_peak(frames, scale: float, grayscale: bool, stream_width: int, stream_quality: int):
+    """
+    Runs the frames once through ORBTracker.track, drawing and encoding with tracemalloc on. Not timed, tracing
+    slows every allocation down.
+    :return: peak traced memory in bytes
+    """
+    tracemalloc.start()
+    try:
+        orb_tracker = ORBTracker(heatmap_size=10, scale=scale, grayscale=grayscale)
+        encoder = StreamEncoder(stream_quality, stream_width, adaptive=False)
+        for frame in frames:
+            frame = frame.copy()
+            orb_tracker.track(frame)
+            orb_tracker.draw_tracks(frame, draw_kp=True, draw_detections=False)
+            encoder.encode(frame)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def bench_pipeline(n_bees: int = 20, speed: float = 5.0, height: int = 720, width: int = 1280, n_frames: int = 200,
+                   warmup: int = 20, seed: int = 0, scale: float = 1.0, grayscale: bool = False,
+                   stream_width: int = None, stream_quality: int = 95):
+    """
+    Runs a synthetic scene through every stage of the pipeline and measures them separately: ORBDetector detections,
+    HungarianTracker assignment on those detections, the full ORBTracker.track path with drawing and the JPEG encode
+    of the stream at stream_width and stream_quality. The first warmup frames are processed but not measured.
+    scale and grayscale set the processing resolution and color of the detector. The peak memory is traced in a
+    separate pass after the timed ones.
+    :return: dictionary with the per stage latency percentiles, fps and the peak memory
+    """
+    frames = list(SyntheticScene(n_bees, speed, height, width, seed=seed).frames(n_frames + warmup))
+    stages = {"detect": [], "track": [], "orb_tracker": [], "draw": [], "encode": []}
+    detector, tracker = ORBDetector(scale=scale, grayscale=grayscale), HungarianTracker()
+    for i, frame in enumerate(frames):
+        start = time.perf_counter()
+        detections = detector.get_detections(frame)
+        detected = time.perf_counter()
+        tracker.get_tracks(detections, i)
+        tracked = time.perf_counter()
+        if i >= warmup:
+            stages["detect"].append((detected - start) * 1000)
+            stages["track"].append((tracked - detected) * 1000)
+    orb_tracker = ORBTracker(heatmap_size=10, scale=scale, grayscale=grayscale)
+    encoder = StreamEncoder(stream_quality, stream_width, adaptive=False)
+    n_detections = 0
+    for i, frame in enumerate(frames):
+        frame = frame.copy()
+        start = time.perf_counter()
+        orb_tracker.track(frame)
+        tracked = time.perf_counter()
+        orb_tracker.draw_tracks(frame, draw_kp=True, draw_detections=False)
+        drawn = time.perf_counter()
+        encoder.encode(frame)
+        encoded = time.perf_counter()
+        if i >= warmup:
+            n_detections += len(orb_tracker.get_detections())
+            stages["orb_tracker"].append((tracked - start) * 1000)
+            stages["draw"].append((drawn - tracked) * 1000)
+            stages["encode"].append((encoded - drawn) * 1000)
+    peak = _traced_peak(frames, scale, grayscale, stream_width, stream_quality)
+    return {"benchmark": "pipeline", "n_bees": n_bees, "speed": speed, "resolution": [width, height],
+            "n_frames": n_frames, "seed": seed, "scale": scale, "grayscale": grayscale,
+            "stream_width": stream_width, "stream_quality": stream_quality, "mean_detections": n_detections / max(n_frames, 1),
+            "stages": {name: _summary(latencies) for name, latencies in stages.items()},
+            "peak_traced_mb": peak / 2 ** 20,
+            "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10}
+
+
+STARTUP_MODULES = ("main", "app", "camera", "supervisor", "batch")
+# dependencies only some code paths need, they shouldn't load when an entry point starts
+OPTIONAL_PACKAGES = ("scipy", "pandas")
+_IMPORTTIME = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)")
+
+
+def _import_profile(module: str):
+    """
+    Imports a module in a fresh interpreter with python -X importtime.
+    :param module:
+    :return: wall time of the interpreter in seconds and a list of package, self and cumulative microseconds, depth
+    """
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True,
+                            text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    wall = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"importing {module} failed:\n{result.stderr.splitlines()[-1]}")
+    imports = []
+    for line in result.stderr.splitlines():
+        match = _IMPORTTIME.match(line)
+        if match is not None:
+            imports.append((match.group(4), int(match.group(1)), int(match.group(2)), len(match.group(3)) // 2))
+    return wall, imports
+
+
+def bench_startup(modules=STARTUP_MODULES, repeats: int = 5, top: int = 10):
+    """
+    Measures the cold start of the entry points: every module is imported repeats times in a fresh interpreter
+    and the fastest run is kept, the first one also compiles the bytecode.
+    :param modules: entry point modules.
+    :param repeats:
+    :param top: number of heaviest top level packages reported per module.
+    :return: dictionary of module to interpreter wall time, import time of the module, the heaviest packages by
+        self time and the optional packages it loads
+    """
+    report = {}
+    for module in modules:
+        runs = [_import_profile(module) for _ in range(repeats)]
+        wall, imports = min(runs, key=lambda run: run[0])
+        packages = {}
+        for name, self_us, _, _ in imports:
+            package = name.split(".")[0]
+            packages[package] = packages.get(package, 0) + self_us
+        heaviest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+        report[module] = {"wall_ms": 1000 * wall,
+                          "import_ms": next(cumulative for name, _, cumulative, _ in imports if name == module) / 1000,
+                          "heaviest_packages_ms": {package: us / 1000 for package, us in heaviest},
+                          "optional_packages": sorted(package for package in OPTIONAL_PACKAGES if package in packages)}
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the bee tracking pipeline.")
+    # every command takes --output after its name
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--output", help="also write the JSON report to this file")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    heatmap_parser = subparsers.add_parser("heatmap", parents=[common],
+                                           help="vectorized heatmap against the per-keypoint loop")
+    heatmap_parser.add_argument("--keypoints", type=int, default=500)
+    heatmap_parser.add_argument("--height", type=int, default=720)
+    heatmap_parser.add_argument("--width", type=int, default=1280)
+    heatmap_parser.add_argument("--heatmap-size", type=int, default=10)
+    heatmap_parser.add_argument("--min-hits", type=int, default=3)
+    heatmap_parser.add_argument("--repeats", type=int, default=50)
+    pipeline_parser = subparsers.add_parser("pipeline", parents=[common],
+                                            help="per stage latency on a synthetic bee video")
+    pipeline_parser.add_argument("--bees", type=int, default=20)
+    pipeline_parser.add_argument("--speed", type=float, default=5.0, help="pixels per frame")
+    pipeline_parser.add_argument("--height", type=int, default=720)
+    pipeline_parser.add_argument("--width", type=int, default=1280)
+    pipeline_parser.add_argument("--frames", type=int, default=200)
+    pipeline_parser.add_argument("--seed", type=int, default=0)
+    pipeline_parser.add_argument("--scale", type=float, default=1.0, help="processing scale of the detector")
+    pipeline_parser.add_argument("--grayscale", action="store_true", help="detect on the grayscale frame")
+    pipeline_parser.add_argument("--stream-width", type=int, default=None, help="width of the encoded stream")
+    pipeline_parser.add_argument("--stream-quality", type=int, default=95, help="JPEG quality of the stream")
+    startup_parser = subparsers.add_parser("startup", parents=[common],
+                                           help="import time of the entry points (python -X importtime)")
+    startup_parser.add_argument("modules", nargs="*", default=list(STARTUP_MODULES))
+    startup_parser.add_argument("--repeats", type=int, default=5)
+    startup_parser.add_argument("--top", type=int, default=10, help="heaviest packages reported per module")
+    startup_parser.add_argument("--budget-ms", type=float, default=None,
+                                help="exit with status 1 when a module takes longer to import")
+    args = parser.parse_args()
+    if args.command == "heatmap":
+        report = bench_heatmap(args.keypoints, args.height, args.width, args.heatmap_size, args.min_hits, args.repeats)
+    elif args.command == "pipeline":
+        report = bench_pipeline(args.bees, args.speed, args.height, args.width, args.frames, seed=args.seed,
+                                scale=args.scale, grayscale=args.grayscale, stream_width=args.stream_width,
+                                stream_quality=args.stream_quality)
+    elif args.command == "startup":
+        report = bench_startup(args.modules, args.repeats, args.top)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.command == "startup" and args.budget_ms is not None:
+        slow = [module for module, result in report.items() if result["import_ms"] > args.budget_ms]
+        if slow:
+            sys.exit(f"over the {args.budget_ms:g} ms import budget: {', '.join(slow)}")
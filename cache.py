@@ -0,0 +1,292 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import cv2
+import numpy as np
+
+from metrics import metrics
+from orb_detector import ORBTracker
+
+CACHE_VERSION = 2
+# ORBTracker settings that change the keypoints, the heatmap, blob and tracker settings are applied on replay
+KEYPOINT_PARAMS = ("prune_bg", "refresh_bg_frame", "scale", "grayscale", "roi", "n_features", "tiles", "motion_gate")
+# stages that still run when the keypoints are replayed
+REPLAYED_STAGES = ("heatmap", "blobs", "assignment", "compaction")
+
+
+def video_hash(path: str, sample_size: int = 1 << 20):
+    """
+    Hashes a video by its size and three samples of its content (start, middle, end), so an hour of footage is
+    identified without reading all of it.
+    :param path:
+    :param sample_size: bytes per sample.
+    :return: hex digest
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.sha256(str(size).encode())
+    with open(path, "rb") as f:
+        for offset in sorted({0, max(size // 2 - sample_size // 2, 0), max(size - sample_size, 0)}):
+            f.seek(offset)
+            digest.update(f.read(sample_size))
+    return digest.hexdigest()
+
+
+def keypoint_key(video_digest: str, tracker: ORBTracker):
+    """
+    Gets the cache key of the keypoints of a video detected with the settings of a tracker.
+    :param video_digest: see video_hash.
+    :param tracker:
+    :return: hex digest
+    """
+    params = {name: getattr(tracker, name) for name in KEYPOINT_PARAMS}
+    if params["roi"] is not None:
+        params["roi"] = [np.asarray(polygon).tolist() for polygon in params["roi"]]
+    params["tiles"] = list(params["tiles"])
+    description = {"version": CACHE_VERSION, "opencv": cv2.__version__, "video": video_digest, "params": params}
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+class CacheEntry:
+    def __init__(self, path: str):
+        """
+        Creates a CacheEntry object over the cached keypoints of one video. Coordinates and descriptors of all
+        frames are two raw binary files which are memory mapped, offsets.npy holds the first row of every frame.
+        :param path: directory of the entry.
+        """
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        self.shape = tuple(self.meta["shape"])
+        self.frame_shape = tuple(self.meta["frame_shape"])
+        self.coords = self._map("coords.bin", np.float32, 2)
+        self.descriptors = self._map("descriptors.bin", np.uint8, 32)
+
+    def _map(self, name: str, dtype, width: int):
+        """
+        Memory maps a raw binary file of rows.
+        :return:
+        """
+        path = os.path.join(self.path, name)
+        if os.path.getsize(path) == 0:
+            return np.empty((0, width), dtype)
+        return np.memmap(path, dtype, "r").reshape(-1, width)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def frame(self, index: int):
+        """
+        Gets the keypoints of a frame.
+        :param index: 0 based frame index.
+        :return: (N, 2) coordinates on the processing scale and (N, 32) descriptors
+        """
+        lo, hi = self.offsets[index], self.offsets[index + 1]
+        return self.coords[lo:hi], self.descriptors[lo:hi]
+
+
+class CacheWriter:
+    def __init__(self, cache, key: str, meta: dict):
+        """
+        Creates a CacheWriter object which appends the keypoints of consecutive frames to a new entry. The entry is
+        written to a temporary directory and only appears in the cache when it is closed.
+        :param cache: DetectionCache.
+        :param key:
+        :param meta: description of the entry, stored in meta.json.
+        """
+        self.cache = cache
+        self.key = key
+        self.meta = dict(meta)
+        self.path = cache.entry_path(key) + f".tmp{os.getpid()}"
+        os.makedirs(self.path, exist_ok=True)
+        self.coords = open(os.path.join(self.path, "coords.bin"), "wb")
+        self.descriptors = open(os.path.join(self.path, "descriptors.bin"), "wb")
+        self.offsets = [0]
+
+    def append(self, coords, descriptors):
+        """
+        Appends the keypoints of the next frame.
+        :param coords: (N, 2) coordinates on the processing scale.
+        :param descriptors: (N, 32) descriptors, None without keypoints.
+        :return:
+        """
+        coords = np.ascontiguousarray(coords, np.float32).reshape(-1, 2)
+        descriptors = np.zeros((0, 32), np.uint8) if descriptors is None else descriptors
+        self.coords.write(coords.tobytes())
+        self.descriptors.write(np.ascontiguousarray(descriptors, np.uint8).tobytes())
+        self.offsets.append(self.offsets[-1] + len(coords))
+
+    def close(self):
+        """
+        Publishes the entry and evicts old entries beyond the cache size.
+        :return:
+        """
+        self.coords.close()
+        self.descriptors.close()
+        np.save(os.path.join(self.path, "offsets.npy"), np.asarray(self.offsets, np.int64))
+        self.meta["frames"] = len(self.offsets) - 1
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump(self.meta, f)
+        final_path = self.cache.entry_path(self.key)
+        if os.path.isdir(final_path):
+            # written meanwhile by another run with the same key
+            shutil.rmtree(self.path)
+        else:
+            os.replace(self.path, final_path)
+        self.cache.evict(keep=(self.key,))
+
+    def abort(self):
+        """
+        Discards the entry.
+        :return:
+        """
+        self.coords.close()
+        self.descriptors.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class DetectionCache:
+    def __init__(self, path: str = "cache", max_bytes: int = 10 << 30):
+        """
+        Creates a DetectionCache object, an on-disk cache of the keypoints and descriptors of every frame of a
+        video, addressed by the video content and the settings that change the keypoints (see keypoint_key).
+        Runs that only change the heatmap, blob or tracker settings replay the keypoints instead of decoding and
+        detecting again. The least recently used entries are evicted beyond max_bytes.
+        :param path: directory of the cache.
+        :param max_bytes: size limit of the cache.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    def entry_path(self, key: str):
+        return os.path.join(self.path, key)
+
+    def get(self, key: str):
+        """
+        Gets an entry and marks it as used.
+        :param key:
+        :return: CacheEntry, None on a miss
+        """
+        path = self.entry_path(key)
+        if not os.path.isfile(os.path.join(path, "meta.json")):
+            return None
+        os.utime(os.path.join(path, "meta.json"))
+        return CacheEntry(path)
+
+    def writer(self, key: str, meta: dict):
+        """
+        Starts a new entry.
+        :param key:
+        :param meta: description of the entry.
+        :return: CacheWriter
+        """
+        return CacheWriter(self, key, meta)
+
+    def _entries(self):
+        """
+        Lists the complete entries with their size and last use.
+        :return: list of key, bytes, last use tuples
+        """
+        entries = []
+        for key in os.listdir(self.path):
+            meta_path = os.path.join(self.path, key, "meta.json")
+            if ".tmp" in key or not os.path.isfile(meta_path):
+                continue
+            size = sum(entry.stat().st_size for entry in os.scandir(os.path.join(self.path, key)))
+            entries.append((key, size, os.path.getmtime(meta_path)))
+        return entries
+
+    def size(self):
+        """
+        Gets the size of the complete entries in bytes.
+        :return:
+        """
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self, keep=()):
+        """
+        Removes the least recently used entries until the cache fits in max_bytes.
+        :param keep: keys that are never removed.
+        :return: removed keys
+        """
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        removed = []
+        for key, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if key in keep:
+                continue
+            shutil.rmtree(self.entry_path(key), ignore_errors=True)
+            total -= size
+            removed.append(key)
+        return removed
+
+
+def _replayed_seconds():
+    return sum(metrics.sums.get(stage, 0.0) for stage in REPLAYED_STAGES)
+
+
+def track_video(video_path: str, cache: DetectionCache = None, tracker_kwargs: dict = None):
+    """
+    Tracks a recorded video, replaying its keypoints from the cache when they were detected before with the same
+    settings, and filling the cache otherwise. The decoding and keypoint cost per frame of the detecting run is
+    kept with the entry and exported as the keypoint_ms_per_frame gauge, also when replaying.
+    :param video_path:
+    :param cache: optional DetectionCache.
+    :param tracker_kwargs: arguments of the ORBTracker.
+    :return: generator of frame number (1 based), frame shape, detections and track ids
+    """
+    tracker = ORBTracker(**(tracker_kwargs or {}))
+    key = keypoint_key(video_hash(video_path), tracker) if cache is not None else None
+    entry = cache.get(key) if cache is not None else None
+    if cache is not None:
+        metrics.increment("keypoint_cache_hits" if entry is not None else "keypoint_cache_misses")
+    if entry is not None:
+        if "keypoint_ms_per_frame" in entry.meta:
+            metrics.set_gauge("keypoint_ms_per_frame", entry.meta["keypoint_ms_per_frame"])
+        for index in range(len(entry)):
+            coords, _ = entry.frame(index)
+            tracker.replay(coords, entry.shape)
+            yield index + 1, entry.frame_shape, tracker.get_detections(), tracker.get_detection_ids()
+        return
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise Exception(f"Could not open video {video_path}")
+    writer = None
+    n_frames = 0
+    busy = 0.0
+    replayed_start = _replayed_seconds()
+    try:
+        while True:
+            start = time.perf_counter()
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if cache is not None and writer is None:
+                meta = {"video": os.path.basename(video_path), "frame_shape": frame.shape,
+                        "shape": tracker.orb_detector._prepare(frame).shape,
+                        "params": {name: str(getattr(tracker, name)) for name in KEYPOINT_PARAMS}}
+                writer = cache.writer(key, meta)
+            tracker.track(frame)
+            if writer is not None:
+                writer.append(tracker.orb_detector.kp_frame, tracker.orb_detector.des_frame)
+            busy += time.perf_counter() - start
+            n_frames += 1
+            yield n_frames, frame.shape, tracker.get_detections(), tracker.get_detection_ids()
+    except BaseException:
+        # a partial run, e.g. a consumer that stopped early, isn't cached
+        if writer is not None:
+            writer.abort()
+        raise
+    finally:
+        cap.release()
+    keypoint_ms = 1000 * (busy - (_replayed_seconds() - replayed_start)) / max(n_frames, 1)
+    metrics.set_gauge("keypoint_ms_per_frame", keypoint_ms)
+    if writer is not None:
+        writer.meta["keypoint_ms_per_frame"] = keypoint_ms
+        writer.close()
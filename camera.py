@@ -1,4 +1,11 @@
+import time
+
 import cv2
+import numpy as np
+
+from encoder import StreamEncoder
+from metrics import metrics
+from sink import open_sink
 from webcamstream import WebcamVideoStream, FPS
 
 from orb_detector import ORBTracker
@@ -6,13 +13,42 @@ from track import HungarianTracker
 
 
 class VideoCap:
-    def __init__(self, video_path=0, refresh_timeout: int = 500, is_direct: bool = False, height: int = 720, width: int = 1280):
+    def __init__(self, video_path=0, refresh_timeout: int = 500, is_direct: bool = False, height: int = 720, width: int = 1280,
+                 bbox_path: str = "bboxes.csv", bbox_format: str = "csv", prefetch: int = 0, drop_frames: bool = None,
+                 process_scale: float = 1.0, grayscale: bool = False, roi=None, tiles=(1, 1),
+                 scheduler=None, encoder: StreamEncoder = None, motion_model: bool = False):
         """
         Creates a VideoCap object with the given video path.
         :param video_path:
         :param refresh_timeout:
+        :param bbox_path: file the tracked detections are appended to, None disables writing them.
+        :param bbox_format: csv for the YOLO text file, npy for a directory of binary column segments with track ids.
+        :param prefetch: number of frames decoded ahead on a reader thread, 0 reads on the calling thread.
+        :param drop_frames: whether a full prefetch queue drops its oldest frame instead of blocking the reader.
+            None drops for cameras and blocks for files.
+        :param process_scale: scale the tracker detects on, boxes are mapped back to the full resolution.
+        :param grayscale: whether the tracker detects on the grayscale frame.
+        :param roi: region of interest polygons or the path of a JSON file with them, see roi.load_roi.
+        :param tiles: rows and columns of tiles the tracker detects in parallel.
+        :param scheduler: optional scheduler.AdaptiveScheduler keeping the tracking within its frame time and
+            latency budget.
+        :param encoder: encoder of the JPEG frames returned when not is_direct, full resolution at the OpenCV
+            default quality when None.
+        :param motion_model: whether the tracker predicts the tracks with a constant velocity Kalman filter, see
+            orb_detector.ORBTracker. Without it the frames the scheduler doesn't detect on keep the last boxes.
         """
         self.tracker = None
+        self.bbox_path = bbox_path
+        self.bbox_format = bbox_format
+        self.process_scale = process_scale
+        self.grayscale = grayscale
+        self.roi = roi
+        self.tiles = tiles
+        self.scheduler = scheduler
+        self.motion_model = motion_model
+        self.encoder = encoder if encoder is not None else StreamEncoder(quality=95, adaptive=False)
+        self.sink = None
+        self.stream = None
         self.fgbg = None
         self.refresh_timeout = refresh_timeout
         self.vs = cv2.VideoCapture(video_path, cv2.CAP_ANY) \
@@ -21,6 +57,9 @@ class VideoCap:
             raise Exception("Could not open video")
         self.vs.set(cv2.CAP_PROP_FRAME_WIDTH, width)
         self.vs.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        if prefetch > 0:
+            drop_frames = isinstance(video_path, int) if drop_frames is None else drop_frames
+            self.stream = WebcamVideoStream(self.vs, queue_size=prefetch, drop_oldest=drop_frames).start()
         self.fps = FPS().start()
         self.n_frames = 0
         self.current_frame = 0
@@ -38,9 +77,51 @@ class VideoCap:
         self.fgbg = cv2.createBackgroundSubtractorMOG2()
         return
 
-    def __del__(self):
+    def release(self):
+        """
+        Releases the video source and flushes the detections file.
+        :return:
+        """
+        if self.sink is not None:
+            self.sink.close()
+            self.sink = None
+        if self.stream is not None:
+            self.stream.release()
         self.vs.release()
 
+    def __del__(self):
+        self.release()
+
+    def read(self):
+        """
+        Reads the next frame, from the prefetch queue when prefetching.
+        :return: grabbed flag and frame
+        """
+        with metrics.timer("capture"):
+            if self.stream is None:
+                return self.vs.read()
+            metrics.set_gauge("prefetch_queue_depth", self.stream.pending())
+            return self.stream.read()
+
+    def skip(self, n_frames: int):
+        """
+        Skips stale frames of the source, queued ones when prefetching. Without prefetching the frames are grabbed
+        without being decoded.
+        :param n_frames: number of frames to skip.
+        :return: number of frames skipped
+        """
+        if n_frames <= 0:
+            return 0
+        if self.stream is not None:
+            skipped = self.stream.skip(n_frames)
+        else:
+            skipped = 0
+            while skipped < n_frames and self.vs.grab():
+                skipped += 1
+        self.current_frame += skipped
+        metrics.increment("scheduler_skipped_frames", skipped)
+        return skipped
+
     def get_frame(self):
         """
         Returns the current frame without any modification to it.
@@ -51,14 +132,21 @@ class VideoCap:
         #     self.current_frame = 0
         #     self.vs.set(cv2.CAP_PROP_POS_FRAMES, 0)
 
-        ret, frame = self.vs.read()
+        ret, frame = self.read()
         if not ret:
             raise Exception("couldn't grab image frame")
         self.fps.update()
         if self.is_direct:
             return frame
-        ret, jpg = cv2.imencode(".jpg", frame)
-        return jpg.tobytes()
+        return self.encode(frame)
+
+    def encode(self, frame):
+        """
+        Encodes a frame as JPEG bytes for the stream.
+        :param frame:
+        :return:
+        """
+        return self.encoder.encode(frame)
 
     def draw_orb_tracks(self, frame, draw_kp: bool = True, draw_detections: bool = False, draw_tracks: bool = True, draw_numbers: bool = True):
         """
@@ -68,7 +156,8 @@ class VideoCap:
         """
         if self.tracker is None:
             return frame
-        self.tracker.draw_tracks(frame, draw_kp, draw_detections, draw_tracks, draw_numbers)
+        with metrics.timer("drawing"):
+            self.tracker.draw_tracks(frame, draw_kp, draw_detections, draw_tracks, draw_numbers)
         return frame
 
     def get_orb_tracking(self, draw_kp: bool = True, draw_detections: bool = False, draw_tracks: bool = True, draw_numbers: bool = True):
@@ -76,35 +165,53 @@ class VideoCap:
         Returns the current frame with the ORB tracks drawn on it.
         :return:
         """
-        ret, frame = self.vs.read()
+        skipped = self.skip(self.scheduler.stale_frames()) if self.scheduler is not None else 0
+        start = time.perf_counter()
+        ret, frame = self.read()
         if not ret:
             raise Exception(f"couldn't grab image frame {self.current_frame}")
         self.current_frame += 1
         self.fps.update()
+        metrics.increment("frames")
         if self.tracker is None:
-            self.tracker = ORBTracker(heatmap_size=10)
-        self.tracker.track(frame)
+            self.tracker = ORBTracker(heatmap_size=10, scale=self.process_scale, grayscale=self.grayscale, roi=self.roi,
+                                      tiles=self.tiles, motion_model=self.motion_model)
+        if self.scheduler is None:
+            self.tracker.track(frame)
+        else:
+            self.tracker.skip(skipped)
+            self.tracker.orb_detector.refresh_bg_frames = self.scheduler.bg_refresh(self.tracker.refresh_bg_frame)
+            if self.scheduler.should_detect():
+                self.tracker.track(frame)
+            else:
+                self.tracker.propagate(frame)
         frame = self.draw_orb_tracks(frame, draw_kp, draw_detections, draw_tracks, draw_numbers)
         self.write_bboxes_to_yolo_format()
-        if self.is_direct:
-            return frame
-        ret, jpg = cv2.imencode(".jpg", frame)
-        return jpg.tobytes()
+        if not self.is_direct:
+            frame = self.encode(frame)
+        if self.scheduler is not None:
+            self.scheduler.record(time.perf_counter() - start)
+        return frame
 
     def write_bboxes_to_yolo_format(self):
         """
-        Writes the bounding boxes to a file.
-        :param bboxes:
+        Queues the bounding boxes of the current frame, normalized by the frame size, for the detections file.
+        Frames the scheduler didn't detect on are left out, their boxes are predictions and would end up as labels.
         :return:
         """
-        with open("bboxes.csv", "a+") as f:
-            for bbox in self.tracker.get_detections():
-                f.write(f"{self.current_frame}\t0\t{bbox[0]/self.width}\t{bbox[1]/self.height}\t{bbox[2]/self.width}\t{bbox[3]/self.width}\n")
+        if self.bbox_path is None or self.tracker.propagated:
+            return
+        if self.sink is None:
+            self.sink = open_sink(self.bbox_path, self.bbox_format)
+        bboxes = np.asarray(self.tracker.get_detections(), float).reshape(-1, 4)
+        metrics.set_gauge("sink_queue_depth", self.sink.queue.qsize())
+        self.sink.write(self.current_frame, bboxes / [self.width, self.height, self.width, self.height],
+                        self.tracker.get_detection_ids())
 
 
     def get_background(self):
         """
-        Returns the current background frame.
+        Returns the foreground mask of the current frame.
         :return:
         """
 
@@ -112,7 +219,7 @@ class VideoCap:
         # if 0 < self.total_frames <= self.current_frame:
         #     self.current_frame = 0
         #     self.vs.set(cv2.CAP_PROP_POS_FRAMES, 0)
-        ret, frame = self.vs.read()
+        ret, frame = self.read()
         if not ret:
             raise Exception("couldn't grab image frame")
         self.fps.update()
@@ -121,6 +228,5 @@ class VideoCap:
         fgmask = self.fgbg.apply(frame)
 
         if self.is_direct:
-            return frame
-        ret, jpg = cv2.imencode(".jpg", fgmask)
-        return jpg.tobytes()
+            return fgmask
+        return self.encode(fgmask)
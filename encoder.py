@@ -0,0 +1,163 @@
+import time
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
+
+import cv2
+
+from metrics import metrics
+
+
+class StreamEncoder:
+    def __init__(self, quality: int = 80, width: int = None, min_quality: int = 30, adaptive: bool = True,
+                 encode_budget: float = 0.02, quality_step: int = 5, settle_frames: int = 30,
+                 smoothing: float = 0.2):
+        """
+        Creates a StreamEncoder object which encodes the preview stream as JPEG, independently of the processing
+        resolution. Frames wider than width are downscaled first. With adaptive, the quality drops by quality_step
+        when the encode time goes over encode_budget (CPU load) or a viewer lags behind and skips frames
+        (bandwidth), and climbs back to quality after settle_frames frames without either.
+        :param quality: JPEG quality, the highest one when adaptive.
+        :param width: stream width in pixels, None streams at the frame resolution.
+        :param min_quality: lowest quality when adaptive.
+        :param adaptive: whether to adapt the quality.
+        :param encode_budget: encode time in seconds above which the quality drops.
+        :param quality_step: quality change of one adaptation.
+        :param settle_frames: number of frames between two adaptations.
+        :param smoothing: weight of the newest encode time in the moving average.
+        """
+        self.max_quality = quality
+        self.quality = quality
+        self.width = width
+        self.min_quality = min_quality
+        self.adaptive = adaptive
+        self.encode_budget = encode_budget
+        self.quality_step = quality_step
+        self.settle_frames = settle_frames
+        self.smoothing = smoothing
+        self.encode_time = None
+        self.frames_since_change = 0
+        self.lagging = False
+
+    def viewer_lag(self, skipped: int):
+        """
+        Reports that a viewer skipped frames because it couldn't keep up.
+        :param skipped: number of frames skipped.
+        :return:
+        """
+        self.lagging = True
+        metrics.increment("stream_skipped_frames", skipped)
+
+    def _adapt(self):
+        """
+        Moves the quality one step according to the encode time and the viewer lag.
+        :return:
+        """
+        self.frames_since_change += 1
+        if not self.adaptive or self.frames_since_change < self.settle_frames:
+            return
+        quality = self.quality
+        if self.lagging or self.encode_time > self.encode_budget:
+            self.quality = max(self.quality - self.quality_step, self.min_quality)
+        elif self.encode_time < 0.7 * self.encode_budget:
+            self.quality = min(self.quality + self.quality_step, self.max_quality)
+        self.lagging = False
+        if self.quality != quality:
+            self.frames_since_change = 0
+        metrics.set_gauge("stream_quality", self.quality)
+
+    def encode(self, frame):
+        """
+        Downscales a frame to the stream width and encodes it as JPEG.
+        :param frame:
+        :return: JPEG bytes
+        """
+        start = time.perf_counter()
+        with metrics.timer("encode"):
+            if self.width is not None and frame.shape[1] > self.width:
+                height = round(frame.shape[0] * self.width / frame.shape[1])
+                frame = cv2.resize(frame, (self.width, height), interpolation=cv2.INTER_AREA)
+            ret, jpg = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            # the one copy of the frame, WSGI servers only write bytes
+            data = jpg.tobytes()
+        seconds = time.perf_counter() - start
+        self.encode_time = seconds if self.encode_time is None else \
+            self.encode_time + self.smoothing * (seconds - self.encode_time)
+        self._adapt()
+        return data
+
+
+class EncodeStage:
+    def __init__(self, producer, encoder: StreamEncoder, idle_timeout: float = 1.0):
+        """
+        Creates an EncodeStage object, a two stage pipeline between frame processing and encoding. The producer
+        runs on a processing thread and hands its frames over one at a time, calling the stage encodes the next
+        frame on the caller's thread, so a frame is encoded while the next one is captured and processed. The
+        processing thread stops when its frame isn't taken within idle_timeout and starts again on the next call.
+        :param producer: callable returning the next frame to stream.
+        :param encoder:
+        :param idle_timeout: seconds the processing thread waits for the consumer.
+        """
+        self.producer = producer
+        self.encoder = encoder
+        self.idle_timeout = idle_timeout
+        self.frames = Queue(maxsize=1)
+        self.lock = Lock()
+        self.thread = None
+
+    def _run(self):
+        """
+        Processing loop, stops at the first error which the consumer raises again.
+        :return:
+        """
+        while True:
+            try:
+                frame = self.producer()
+            except Exception as e:
+                frame = e
+            try:
+                self.frames.put(frame, timeout=self.idle_timeout)
+            except Full:
+                frame = None
+            if frame is None or isinstance(frame, Exception):
+                with self.lock:
+                    self.thread = None
+                return
+
+    def _start(self):
+        """
+        Starts the processing thread unless it runs.
+        :return:
+        """
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def __call__(self):
+        """
+        Gets the next processed frame and encodes it.
+        :return: JPEG bytes
+        """
+        while True:
+            self._start()
+            try:
+                frame = self.frames.get(timeout=0.1)
+                break
+            except Empty:
+                pass
+        if isinstance(frame, Exception):
+            raise frame
+        return self.encoder.encode(frame)
+
+
+def multipart_frames(frames):
+    """
+    Wraps encoded frames as multipart JPEG parts. The boundary, the JPEG bytes and the trailer are yielded
+    separately, so the JPEG isn't copied into a new bytes object for every viewer.
+    :param frames: iterable of JPEG bytes.
+    :return:
+    """
+    for frame in frames:
+        yield b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % len(frame)
+        yield frame
+        yield b'\r\n\r\n'
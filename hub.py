@@ -0,0 +1,112 @@
+from threading import Condition, Lock, Thread
+
+from encoder import EncodeStage
+
+
+class FrameBroadcast:
+    def __init__(self, producer, on_lag=None):
+        """
+        Creates a FrameBroadcast object. One worker thread calls producer for every frame and publishes the result,
+        any number of subscribers then get the latest frame. A subscriber that is slower than the worker skips the
+        frames it missed instead of holding up the worker. The worker runs while there are subscribers.
+        :param producer: callable returning the next encoded frame.
+        :param on_lag: optional callable(skipped) told when a subscriber skipped frames.
+        """
+        self.producer = producer
+        self.on_lag = on_lag
+        self.condition = Condition()
+        self.frame = None
+        self.sequence = 0
+        self.subscribers = 0
+        self.thread = None
+        self.error = None
+
+    def _run(self):
+        """
+        Worker loop, produces frames until the last subscriber left or the producer failed.
+        :return:
+        """
+        while True:
+            with self.condition:
+                if self.subscribers == 0:
+                    self.thread = None
+                    return
+            try:
+                frame = self.producer()
+            except Exception as e:
+                with self.condition:
+                    self.error = e
+                    self.thread = None
+                    self.condition.notify_all()
+                return
+            with self.condition:
+                self.frame = frame
+                self.sequence += 1
+                self.condition.notify_all()
+
+    def subscribe(self):
+        """
+        Yields every frame published after subscribing, skipping the ones published while the caller was busy.
+        :return: generator of frames
+        """
+        with self.condition:
+            self.subscribers += 1
+            self.error = None
+            if self.thread is None:
+                self.thread = Thread(target=self._run, daemon=True)
+                self.thread.start()
+            last = self.sequence
+        try:
+            while True:
+                with self.condition:
+                    self.condition.wait_for(lambda: self.sequence != last or self.error is not None)
+                    if self.sequence == last:
+                        return
+                    skipped = self.sequence - last - 1
+                    frame, last = self.frame, self.sequence
+                if skipped > 0 and self.on_lag is not None:
+                    self.on_lag(skipped)
+                yield frame
+        finally:
+            with self.condition:
+                self.subscribers -= 1
+
+
+class FrameHub:
+    def __init__(self, camera, producers: dict, encoder_factory=None):
+        """
+        Creates a FrameHub object which shares one camera between any number of viewers. Every stream type has
+        its own FrameBroadcast, so a frame is captured, processed and encoded once whatever the number of viewers.
+        Capture is serialised between stream types because they read the same camera.
+        With encoder_factory the producers return raw frames, every stream type then encodes them with its own
+        encoder.StreamEncoder on the broadcast thread while the next frame is processed on an EncodeStage thread,
+        and the encoder is told about lagging viewers.
+        :param camera: shared camera, passed to the producers.
+        :param producers: stream type to callable(camera) returning the next encoded frame, the next raw frame
+            with encoder_factory.
+        :param encoder_factory: optional callable returning a new StreamEncoder.
+        """
+        self.camera = camera
+        self.lock = Lock()
+        self.broadcasts = {}
+        for video_type, producer in producers.items():
+            if encoder_factory is None:
+                self.broadcasts[video_type] = FrameBroadcast(self._producer(producer))
+            else:
+                encoder = encoder_factory()
+                self.broadcasts[video_type] = FrameBroadcast(EncodeStage(self._producer(producer), encoder),
+                                                             on_lag=encoder.viewer_lag)
+
+    def _producer(self, producer):
+        def produce():
+            with self.lock:
+                return producer(self.camera)
+        return produce
+
+    def stream(self, video_type: str):
+        """
+        Subscribes to a stream type.
+        :param video_type:
+        :return: generator of encoded frames
+        """
+        return self.broadcasts[video_type].subscribe()
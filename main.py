@@ -1,21 +1,47 @@
+import argparse
+import itertools
 import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
-import cv2
 import time
 
-import pandas as pd
+import numpy as np
 
-from camera import VideoCap
+from sink import DetectionReader, open_sink
 
-def run_detection(video_path: int = 0, draw_detections=True, draw_tracks=False, draw_kp=True, draw_numbers=True):
+# cv2 and the tracking stack are imported by the commands that use them, exporting labels doesn't need them
+
+def run_detection(video_path: int = 0, draw_detections=True, draw_tracks=False, draw_kp=True, draw_numbers=True,
+                  prefetch: int = 8, target_fps: float = None, cache_dir: str = None, motion_model: bool = False):
     """
     Runs the detection on a video.
     :param video_path:
-    :param refresh_timeout:
+    :param prefetch: number of frames decoded ahead of the tracker on a reader thread.
+    :param target_fps: processing rate kept by an adaptive scheduler, None tracks every frame in full.
+    :param cache_dir: keypoint cache of recorded videos, see cache.DetectionCache. A cached video is tracked
+        without decoding it and nothing is drawn.
+    :param motion_model: whether the tracks are predicted with a constant velocity Kalman filter.
     :return:
     """
+    import cv2
+    from cache import DetectionCache, track_video
+    from camera import VideoCap
+    from scheduler import AdaptiveScheduler
+    if cache_dir is not None and not isinstance(video_path, int):
+        with open_sink("bboxes.csv", "csv") as sink:
+            for frame_number, shape, detections, track_ids in track_video(video_path, DetectionCache(cache_dir),
+                                                                          {"heatmap_size": 10,
+                                                                           "motion_model": motion_model}):
+                height, width = shape[:2]
+                sink.write(frame_number, np.asarray(detections, float).reshape(-1, 4) / [width, height, width, height],
+                           track_ids)
+                if frame_number % 100 == 0:
+                    print("Tracking frame {}".format(frame_number), end="\r")
+        return
     start_time = time.time()
-    cam = VideoCap(video_path=video_path, is_direct = True)
+    scheduler = AdaptiveScheduler(target_fps, live=isinstance(video_path, int)) if target_fps else None
+    cam = VideoCap(video_path=video_path, is_direct = True, prefetch=prefetch, scheduler=scheduler,
+                   motion_model=motion_model)
     #print camera height and width
 
     nframes = 0
@@ -25,6 +51,8 @@ def run_detection(video_path: int = 0, draw_detections=True, draw_tracks=False,
         try:
             frame = cam.get_orb_tracking(draw_kp=draw_kp, draw_detections=draw_detections, draw_tracks=draw_tracks, draw_numbers=draw_numbers)
             nframes += 1
+            if nframes % 100 == 0:
+                print("Tracking frame {} at {:.1f} fps".format(nframes, cam.fps.fps()), end="\r")
             #cv2.putText(frame, "FPS: {:.2f}".format(cam.fps.fps()), (0, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
             # resize the frame to fit the screen
             #frame = cv2.resize(frame, (1280, 720))
@@ -35,10 +63,11 @@ def run_detection(video_path: int = 0, draw_detections=True, draw_tracks=False,
         except Exception as e:
             print(e)
             break
-    cam.vs.release()
+    cam.release()
     cv2.destroyAllWindows()
 #
 def test_cameras():
+    import cv2
     cap = cv2.VideoCapture(0, cv2.CAP_DSHOW)
     cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1280)
     cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 720)
@@ -59,6 +88,7 @@ def convert_video(video_path: str, output_path: str):
     :param output_path:
     :return:
     """
+    import cv2
     out_size = (640, 360)
     cap = cv2.VideoCapture(video_path)
     height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
@@ -79,18 +109,77 @@ def convert_video(video_path: str, output_path: str):
     cv2.destroyAllWindows()
 
 
-def yolo_writer():
-    import pandas as pd
-    csv = pd.read_csv("bboxes.csv", sep='\t', names=["frame", "bee_id", "x", "y", "w", "h"])
-    counter = 0
-    for i in range(1, 5600):
-        rows = csv[csv.frame == i]
-        if rows.shape[0] > 0:
-            with open("data\\vi_0001_20220725_115507\\obj_train_data\\frame_{:06d}.txt".format(i-1), "w") as f:
-                for row in rows.itertuples():
-                    f.write(f"0 {row.x:0.6f} {row.y:0.6f} {row.w:0.6f} {row.h:0.6f}\n")
-                print(f"{counter} obj_train_data\\frame_{i:06d}.txt")
-                counter += 1
+def _frame_groups(input_path: str):
+    """
+    Streams a detections file once and yields its rows grouped by consecutive frame.
+    :param input_path: tab separated detections file or a directory written by ColumnarDetectionSink.
+    :return: generator of frame, list of x, y, w, h tuples
+    """
+    if os.path.isdir(input_path):
+        for columns in DetectionReader(input_path).segments(("frame", "x", "y", "w", "h")):
+            frames = np.asarray(columns["frame"])
+            boxes = np.column_stack([columns["x"], columns["y"], columns["w"], columns["h"]]).tolist()
+            bounds = np.concatenate([[0], np.flatnonzero(np.diff(frames)) + 1, [len(frames)]])
+            for lo, hi in zip(bounds[:-1], bounds[1:]):
+                yield int(frames[lo]), boxes[lo:hi]
+        return
+    with open(input_path) as f:
+        rows = (line.split("\t") for line in f if line.strip())
+        for frame, group in itertools.groupby(rows, key=lambda row: int(row[0])):
+            yield frame, [(float(x), float(y), float(w), float(h)) for _, _, x, y, w, h in group]
+
+
+def _write_labels(path: str, boxes, mode: str = "w"):
+    """
+    Writes the YOLO labels of one frame.
+    :param path: label file.
+    :param boxes: list of x, y, w, h tuples.
+    :param mode: w for the first group of a frame, a for later ones.
+    :return:
+    """
+    with open(path, mode) as f:
+        f.write("".join(f"0 {x:0.6f} {y:0.6f} {w:0.6f} {h:0.6f}\n" for x, y, w, h in boxes))
+
+
+def yolo_writer(input_path: str = "bboxes.csv", output_dir: str = "obj_train_data", frame_offset: int = -1,
+                workers: int = 0):
+    """
+    Exports a detections file to YOLO labels, one frame_XXXXXX.txt per frame with detections.
+    The input is streamed once and grouped by frame. A frame which shows up again later in the file, e.g. from an
+    appended second run, is appended to the labels already written for it.
+    :param input_path: tab separated detections file or a directory written by ColumnarDetectionSink.
+    :param output_dir: directory of the label files.
+    :param frame_offset: added to the frame number to get the label file number.
+    :param workers: number of threads writing label files, 0 writes them on the calling thread.
+    :return: number of label files written
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    written = set()
+    # writes in flight by frame, bounded so a long file isn't buffered in the queue of the pool
+    pending = {}
+    max_pending = 4 * workers
+    executor = ThreadPoolExecutor(workers) if workers > 0 else None
+    for frame, boxes in _frame_groups(input_path):
+        path = os.path.join(output_dir, "frame_{:06d}.txt".format(frame + frame_offset))
+        mode = "a" if frame in written else "w"
+        written.add(frame)
+        if executor is None:
+            _write_labels(path, boxes, mode)
+            continue
+        if frame in pending:
+            # the earlier write of the same file has to finish before appending to it
+            pending.pop(frame).result()
+        if len(pending) >= max_pending:
+            done, _ = wait(pending.values(), return_when=FIRST_COMPLETED)
+            for done_frame in [f for f, future in pending.items() if future in done]:
+                pending.pop(done_frame).result()
+        pending[frame] = executor.submit(_write_labels, path, boxes, mode)
+    if executor is not None:
+        for future in pending.values():
+            future.result()
+        executor.shutdown()
+    return len(written)
+
 
 def yolo_checker():
     import os
@@ -114,6 +203,28 @@ def yolo_checker():
 
 
 if __name__ == "__main__":
-    #test_cameras()
-    run_detection(video_path='media/vi_0001_20220725_115507.mp4', draw_detections=True, draw_tracks=False, draw_kp=False, draw_numbers=False)
-    #convert_video(video_path='media/raspivid90_1.h264', output_path='media/raspivid90_1.h264.avi')
+    parser = argparse.ArgumentParser(description="Bee detection and tracking.")
+    subparsers = parser.add_subparsers(dest="command")
+    detect_parser = subparsers.add_parser("detect", help="track the bees of a video")
+    detect_parser.add_argument("video", nargs="?", default="media/vi_0001_20220725_115507.mp4")
+    detect_parser.add_argument("--target-fps", type=float, default=None,
+                               help="decimate detection under load to keep this processing rate")
+    detect_parser.add_argument("--cache-dir", default=None, help="replay the keypoints of a video tracked before")
+    detect_parser.add_argument("--motion-model", action="store_true",
+                               help="predict the tracks with a constant velocity Kalman filter")
+    export_parser = subparsers.add_parser("export", help="export a detections file to YOLO labels")
+    export_parser.add_argument("input", help="detections csv file or npy directory")
+    export_parser.add_argument("output_dir", help="directory of the label files")
+    export_parser.add_argument("--frame-offset", type=int, default=-1, help="added to the frame number")
+    export_parser.add_argument("--workers", type=int, default=0, help="threads writing label files")
+    args = parser.parse_args()
+    if args.command == "export":
+        n_files = yolo_writer(args.input, args.output_dir, args.frame_offset, args.workers)
+        print(f"{n_files} label files written to {args.output_dir}")
+    else:
+        #test_cameras()
+        run_detection(video_path=getattr(args, "video", 'media/vi_0001_20220725_115507.mp4'), draw_detections=True,
+                      draw_tracks=False, draw_kp=False, draw_numbers=False,
+                      target_fps=getattr(args, "target_fps", None), cache_dir=getattr(args, "cache_dir", None),
+                      motion_model=getattr(args, "motion_model", False))
+        #convert_video(video_path='media/raspivid90_1.h264', output_path='media/raspivid90_1.h264.avi')
@@ -0,0 +1,155 @@
+import os
+import time
+from collections import deque
+from threading import Lock
+
+import numpy as np
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name: str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return None
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Metrics:
+    def __init__(self, window: int = 512, enabled: bool = True, prefix: str = "track_bees"):
+        """
+        Creates a Metrics object, a small registry of stage timings, gauges and counters.
+        Stage timings use the monotonic perf_counter clock and keep the last window observations for the quantiles
+        next to a lifetime sum and count. When disabled, timer returns a shared no-op context manager and the other
+        methods return immediately, so instrumented code pays for an attribute lookup only.
+        :param window: number of observations kept per stage for the quantiles.
+        :param enabled: whether to record anything.
+        :param prefix: prefix of the exported metric names.
+        """
+        self.window = window
+        self.enabled = enabled
+        self.prefix = prefix
+        self.lock = Lock()
+        self.timings = {}
+        self.sums = {}
+        self.counts = {}
+        self.gauges = {}
+        self.counters = {}
+
+    def timer(self, name: str):
+        """
+        Times the enclosed block as stage name.
+        :param name: stage name.
+        :return: context manager
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def observe(self, name: str, seconds: float):
+        """
+        Records one duration of a stage.
+        :param name: stage name.
+        :param seconds:
+        :return:
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            if name not in self.timings:
+                self.timings[name] = deque(maxlen=self.window)
+                self.sums[name] = 0.0
+                self.counts[name] = 0
+            self.timings[name].append(seconds)
+            self.sums[name] += seconds
+            self.counts[name] += 1
+
+    def set_gauge(self, name: str, value: float):
+        """
+        Sets a gauge such as a queue depth.
+        :param name:
+        :param value:
+        :return:
+        """
+        if self.enabled:
+            self.gauges[name] = value
+
+    def increment(self, name: str, value: float = 1):
+        """
+        Increments a counter.
+        :param name:
+        :param value:
+        :return:
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def quantiles(self, name: str, quantiles=(0.5, 0.9, 0.99)):
+        """
+        Gets the quantiles of the recent durations of a stage in seconds.
+        :param name: stage name.
+        :param quantiles:
+        :return: dictionary of quantile to seconds
+        """
+        with self.lock:
+            values = np.array(self.timings.get(name, ()))
+        if len(values) == 0:
+            return {q: float("nan") for q in quantiles}
+        return dict(zip(quantiles, np.quantile(values, quantiles).tolist()))
+
+    def prometheus(self):
+        """
+        Renders every metric in the Prometheus text exposition format.
+        :return:
+        """
+        lines = [f"# HELP {self.prefix}_stage_seconds Duration of the pipeline stages over a rolling window.",
+                 f"# TYPE {self.prefix}_stage_seconds summary"]
+        for name in sorted(self.timings):
+            for q, value in self.quantiles(name).items():
+                lines.append(f'{self.prefix}_stage_seconds{{stage="{name}",quantile="{q}"}} {value}')
+            lines.append(f'{self.prefix}_stage_seconds_sum{{stage="{name}"}} {self.sums[name]}')
+            lines.append(f'{self.prefix}_stage_seconds_count{{stage="{name}"}} {self.counts[name]}')
+        for name, value in sorted(self.gauges.items()):
+            lines.append(f"# TYPE {self.prefix}_{name} gauge")
+            lines.append(f"{self.prefix}_{name} {value}")
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE {self.prefix}_{name}_total counter")
+            lines.append(f"{self.prefix}_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        """
+        Forgets every recorded value.
+        :return:
+        """
+        with self.lock:
+            self.timings.clear()
+            self.sums.clear()
+            self.counts.clear()
+            self.gauges.clear()
+            self.counters.clear()
+
+
+# process wide registry, TRACK_BEES_METRICS=0 turns the instrumentation off
+metrics = Metrics(enabled=os.environ.get("TRACK_BEES_METRICS", "1") != "0")
@@ -0,0 +1,89 @@
+import cv2
+import numpy as np
+
+from metrics import metrics
+
+
+class MotionGate:
+    def __init__(self, scale: float = 0.25, min_fraction: float = 0.0005, dilation: int = 16, warmup: int = 50,
+                 var_threshold: float = 16, min_blob: int = 3):
+        """
+        Creates a MotionGate object which decides where the detector has to look. A small MOG2 model runs on a
+        downscaled grayscale copy of the frame and gives the foreground fraction and regions. Frames with less
+        foreground than min_fraction are idle and need no keypoints at all, the others are restricted to the
+        foreground dilated by dilation pixels so bees at the edge of the motion keep their keypoints.
+        The first warmup frames, while the model learns the background, are never gated.
+        :param scale: scale of the gate frame relative to the processed frame.
+        :param min_fraction: foreground fraction below which a frame is idle.
+        :param dilation: margin in processed frame pixels added around the foreground.
+        :param warmup: number of frames before gating.
+        :param var_threshold: MOG2 variance threshold.
+        :param min_blob: smallest foreground blob in gate frame pixels, smaller ones are sensor noise.
+        """
+        self.scale = scale
+        self.min_fraction = min_fraction
+        self.warmup = warmup
+        self.dilation = dilation
+        self.min_blob = min_blob
+        self.bgsub = cv2.createBackgroundSubtractorMOG2(varThreshold=var_threshold, detectShadows=False)
+        size = max(2 * int(np.ceil(dilation * scale)) + 1, 3)
+        self.kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (size, size))
+        self.n_frames = 0
+        self.n_idle = 0
+        self.gated_area = 0.0
+        self.foreground_fraction = 0.0
+        self.regions = np.empty((0, 4), int)
+
+    def update(self, image, mask=None):
+        """
+        Updates the background model with a frame and gets the detection mask.
+        :param image: processed frame.
+        :param mask: optional mask the detection is already restricted to, e.g. the region of interest.
+        :return: mask to detect in, None to detect everywhere, False for an idle frame
+        """
+        self.n_frames += 1
+        small = cv2.resize(image, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        foreground = self.bgsub.apply(small)
+        if self.n_frames <= self.warmup:
+            return mask
+        if mask is not None:
+            small_mask = cv2.resize(mask, (small.shape[1], small.shape[0]), interpolation=cv2.INTER_NEAREST)
+            foreground = cv2.bitwise_and(foreground, small_mask)
+        _, labels, stats, _ = cv2.connectedComponentsWithStats(foreground)
+        # blobs of a few pixels are sensor noise, an opening would also erase the bees of a small gate frame
+        keep = stats[:, cv2.CC_STAT_AREA] >= self.min_blob
+        keep[0] = False
+        foreground = (keep.astype(np.uint8) * 255)[labels]
+        self.foreground_fraction = stats[keep, cv2.CC_STAT_AREA].sum() / foreground.size
+        metrics.set_gauge("motion_foreground_fraction", self.foreground_fraction)
+        if self.foreground_fraction < self.min_fraction:
+            self.n_idle += 1
+            self.regions = np.empty((0, 4), int)
+            metrics.increment("motion_idle_frames")
+            return False
+        # x, y, w, h of the moving blobs in processed frame pixels, grown by the dilation
+        regions = stats[keep, :4] / self.scale
+        regions[:, :2] -= self.dilation
+        regions[:, 2:] += 2 * self.dilation
+        self.regions = np.round(regions).astype(int)
+        gate = cv2.dilate(foreground, self.kernel)
+        gate = cv2.resize(gate, (image.shape[1], image.shape[0]), interpolation=cv2.INTER_NEAREST)
+        if mask is not None:
+            gate = cv2.bitwise_and(gate, mask)
+        area = cv2.countNonZero(gate) / gate.size
+        self.gated_area += area
+        metrics.increment("motion_gated_frames")
+        metrics.set_gauge("motion_gated_area_fraction", area)
+        return gate
+
+    def statistics(self):
+        """
+        Gets the gate statistics since its creation.
+        :return: dictionary with the number of frames, the fraction of idle frames and the mean fraction of the frame
+            detected in, both after the warmup
+        """
+        gated = max(self.n_frames - self.warmup, 1)
+        return {"frames": self.n_frames, "idle_fraction": self.n_idle / gated,
+                "mean_detected_area": self.gated_area / gated}
@@ -1,22 +1,89 @@
 import cv2
 import numpy as np
 
+from metrics import metrics
+from motion import MotionGate
+from overlay import TrailOverlay
+from roi import TiledORB, load_roi, roi_mask
 from track import HungarianTracker
 
 
+def keypoint_coordinates(keypoints):
+    """
+    Converts a sequence of cv2.KeyPoint into an (N, 2) float32 array of x, y coordinates.
+    :param keypoints: keypoints as returned by detectAndCompute.
+    :return:
+    """
+    if keypoints is None or len(keypoints) == 0:
+        return np.empty((0, 2), np.float32)
+    return np.asarray(cv2.KeyPoint_convert(keypoints), np.float32).reshape(-1, 2)
+
+
+def keypoint_heatmap(points, shape, heatmap_size: int, min_hits: int):
+    """
+    Builds the keypoint density heatmap in a single pass. Every keypoint votes for the window
+    [y - heatmap_size, y + heatmap_size) x [x - heatmap_size, x + heatmap_size) clipped to the frame.
+    The votes are scatter-added into a count image which is then spread with one unnormalized box filter,
+    so the cost barely depends on the number of keypoints. The box sum saturates at 255 instead of wrapping
+    around and pixels with less than min_hits votes are zeroed.
+    :param points: (N, 2) array of keypoint x, y coordinates.
+    :param shape: shape of the frame, only the first two dimensions are used.
+    :param heatmap_size: half size of the window each keypoint votes for.
+    :param min_hits: minimum number of votes for a pixel to be kept.
+    :return: uint8 heatmap of the frame size.
+    """
+    height, width = shape[:2]
+    points = np.asarray(points).reshape(-1, 2)
+    if len(points) == 0 or heatmap_size <= 0:
+        return np.zeros((height, width), np.uint8)
+    xs = np.clip(points[:, 0].astype(np.intp), 0, width - 1)
+    ys = np.clip(points[:, 1].astype(np.intp), 0, height - 1)
+    pixels, hits = np.unique(ys * width + xs, return_counts=True)
+    counts = np.zeros((height, width), np.uint8)
+    counts.flat[pixels] = np.minimum(hits, 255)
+    # the anchor makes pixel (r, c) sum the keypoints with r - heatmap_size < y <= r + heatmap_size (same for x)
+    window = 2 * heatmap_size
+    anchor = heatmap_size - 1
+    heatmap = cv2.boxFilter(counts, -1, (window, window), anchor=(anchor, anchor), normalize=False,
+                            borderType=cv2.BORDER_CONSTANT)
+    cv2.threshold(heatmap, min_hits - 1, 0, cv2.THRESH_TOZERO, dst=heatmap)
+    return heatmap
+
+
 class ORBDetector:
     def __init__(self, prune_bg: bool = True, refresh_bg_frame: int = 10, heatmap_size: int = 10,
-                 min_hits: int = 3, min_detection_area: int = 50, max_detection_area: int = 5000):
+                 min_hits: int = 3, min_detection_area: int = 50, max_detection_area: int = 5000, scale: float = 1.0,
+                 grayscale: bool = False, roi=None, n_features: int = 500, tiles=(1, 1), tile_overlap: int = 32,
+                 motion_gate: bool = False):
         """
         Creates a ORBDetector object. prune_bg determines whether to prune the background keypoints and descriptors.
         refresh_bg_frame determines how often to refresh the background keypoints and descriptors.
         heatmap_size determines the size of the heatmap. heatmap_threshold determines the threshold for the heatmap.
+        scale is the processing scale: keypoints, the background model and the heatmap are computed on the frame
+        resized by scale, while heatmap_size, the detection areas, the detections and the keypoints returned by
+        get_frame_keypoints stay in full resolution pixels. Bees have to stay a few ORB patches large at the
+        processing scale to keep their keypoints. grayscale processes a single channel frame.
         :param prune_bg: Whether to prune the background keypoints and descriptors.
         :param refresh_bg_frame: the number of frames after which to refresh the background keypoints and descriptors.
         :param heatmap_size: size of the heatmap
         :param min_hits: minimum number of hits to be considered a detection.
+        :param scale: processing scale, 0.5 processes a quarter of the pixels.
+        :param grayscale: whether to process the grayscale frame.
+        :param roi: region of interest polygons in full resolution pixels, or the path of a JSON file with them
+            (see roi.load_roi). Features are only detected inside the polygons.
+        :param n_features: ORB feature budget of a frame.
+        :param tiles: rows and columns of tiles detected in parallel with per tile budgets (see roi.TiledORB),
+            (1, 1) detects the frame at once.
+        :param tile_overlap: pixels of overlap between neighbouring tiles.
+        :param motion_gate: whether to skip the keypoints of frames without motion and restrict them to the moving
+            regions otherwise, see motion.MotionGate. On idle frames the background model is only fed every
+            refresh_bg_frame frames.
         """
-        self.orb = cv2.ORB_create()
+        self.orb = cv2.ORB_create(nfeatures=n_features)
+        self.roi = load_roi(roi) if isinstance(roi, str) else roi
+        self.mask = None
+        self.tiled_orb = TiledORB(tiles, tile_overlap, n_features) if tuple(tiles) != (1, 1) else None
+        self.motion_gate = MotionGate() if motion_gate else None
         self.bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
         self.bgsub = cv2.createBackgroundSubtractorMOG2()
         self.kp_bg = None
@@ -30,13 +97,17 @@ class ORBDetector:
         self.min_hits = min_hits
         self.min_detection_area = min_detection_area
         self.max_detection_area = max_detection_area
+        self.scale = scale
+        self.grayscale = grayscale
 
     def get_frame_keypoints(self):
         """
-        Gets the keypoints of the frame.
+        Gets the keypoints of the frame as an (N, 2) array of full resolution x, y coordinates.
         :return:
         """
-        return self.kp_frame
+        if self.scale == 1 or self.kp_frame is None:
+            return self.kp_frame
+        return self.kp_frame / self.scale
 
     def get_frame_descriptors(self):
         """
@@ -54,98 +125,182 @@ class ORBDetector:
 
     def get_bg_keypoints(self):
         """
-        Gets the background keypoints.
+        Gets the background keypoints as an (N, 2) array of x, y coordinates.
         :return:
         """
         return self.kp_bg
 
+    def _roi_mask(self, shape):
+        """
+        Gets the region of interest mask of the processing shape.
+        :param shape:
+        :return: mask, None without a region of interest
+        """
+        if self.roi is not None and (self.mask is None or self.mask.shape != shape[:2]):
+            self.mask = roi_mask(self.roi, shape, self.scale)
+        return self.mask
+
+    def _detect(self, image, mask=None):
+        """
+        Detects the features of an image inside the mask, tile by tile when tiling is enabled.
+        :param image:
+        :param mask: detectAndCompute mask, None detects everywhere.
+        :return: (N, 2) coordinates and descriptors
+        """
+        if self.tiled_orb is not None:
+            return self.tiled_orb.detect_and_compute(image, mask)
+        keypoints, descriptors = self.orb.detectAndCompute(image, mask)
+        return keypoint_coordinates(keypoints), descriptors
+
     def _compute_bg(self, frame):
         """
         Computes the background keypoints and descriptors.
         :param frame:
         :return:
         """
-        self.bgsub.apply(frame)
+        with metrics.timer("background_subtraction"):
+            self.bgsub.apply(frame)
         if self.n_frames % self.refresh_bg_frames == 0 or self.n_frames == 1:
-            self.kp_bg, self.des_bg = self.orb.detectAndCompute(self.bgsub.getBackgroundImage(), None)
+            with metrics.timer("background_keypoints"):
+                background = self.bgsub.getBackgroundImage()
+                self.kp_bg, self.des_bg = self._detect(background, self._roi_mask(background.shape))
         return
 
     def _prune_matches(self):
         """
-        Prunes the matches between the background and the frame keypoints.
+        Prunes the frame keypoints that match a background descriptor. The matched query indices are cleared in a
+        boolean mask so the cost is linear in the number of keypoints. Keypoints stay an (N, 2) coordinate array
+        and descriptors one contiguous uint8 array. Nothing is pruned when either side has no descriptors.
         :return:
         """
-        matches = self.bf.match(self.des_frame, self.des_bg)
-        match_idx = np.array([m.queryIdx for m in matches])
-        bg_idx = np.array([i for i in range(len(self.kp_frame)) if i not in match_idx])
-        self.kp_frame = np.array([self.kp_frame[i] for i in bg_idx])
-        self.des_frame = np.array([self.des_frame[i] for i in bg_idx])
+        if self.des_frame is None or self.des_bg is None or len(self.des_frame) == 0 or len(self.des_bg) == 0:
+            return self.kp_frame, self.des_frame
+        with metrics.timer("pruning"):
+            matches = self.bf.match(self.des_frame, self.des_bg)
+            keep = np.ones(len(self.des_frame), bool)
+            keep[np.fromiter((m.queryIdx for m in matches), np.intp, len(matches))] = False
+            self.kp_frame = self.kp_frame[keep]
+            self.des_frame = np.ascontiguousarray(self.des_frame[keep])
         return self.kp_frame, self.des_frame
 
     def _get_keypoints(self, image):
         """
-        Gets the keypoints and descriptors of the frame.
+        Gets the keypoints and descriptors of the frame. Keypoints are kept as an (N, 2) array of x, y coordinates.
         :param image:
         :return:
         """
         self.n_frames += 1
-        self.kp_frame, self.des_frame = self.orb.detectAndCompute(image, None)
+        mask = self._roi_mask(image.shape)
+        if self.motion_gate is not None:
+            with metrics.timer("motion_gate"):
+                mask = self.motion_gate.update(image, mask)
+            if mask is False:
+                self.kp_frame, self.des_frame = np.empty((0, 2), np.float32), None
+                # keep the background model following the light while nothing moves
+                if self.prune_bg and self.n_frames % self.refresh_bg_frames == 0:
+                    self._compute_bg(image)
+                return self.kp_frame, self.des_frame
+        with metrics.timer("detect_and_compute"):
+            self.kp_frame, self.des_frame = self._detect(image, mask)
         if self.prune_bg:
             self._compute_bg(image)
             self.kp_frame, self.des_frame = self._prune_matches()
         return self.kp_frame, self.des_frame
 
-    def get_detections(self, image):
+    def _prepare(self, image):
         """
-        Gets the detections of the frame.
+        Converts the frame to the processing scale and color.
         :param image:
         :return:
         """
+        if self.grayscale and image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        if self.scale != 1:
+            image = cv2.resize(image, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        return image
+
+    def get_detections(self, image):
+        """
+        Gets the detections of the frame in full resolution pixels. The blobs of the heatmap are measured in one
+        connectedComponentsWithStats call and filtered by their pixel area.
+        :param image:
+        :return: (N, 4) array of center x, center y, w, h
+        """
+        image = self._prepare(image)
         self._get_keypoints(image)
-        heatmap = self._create_heatmap(image)
-        contours, _ = cv2.findContours(heatmap, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        detections = []
-        for contour in contours:
-            x, y, w, h = cv2.boundingRect(contour)
-            area = cv2.contourArea(contour)
-            # write area to heatmap
-            #cv2.putText(heatmap, str(area), (x, y), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
-            #print(area, self.min_detection_area, self.max_detection_area, end="\r\n")
-            if self.max_detection_area > area > self.min_detection_area:
-                cv2.drawContours(heatmap, [contour], -1, (255, 255, 255), 2)
-                detections.append(np.array([x + w // 2, y + h // 2, w, h])) # x, y, w, h
+        return self.detections_from_keypoints(self.kp_frame, image.shape)
 
+    def detections_from_keypoints(self, points, shape):
+        """
+        Gets the detections of keypoints found earlier, e.g. replayed from a cache.DetectionCache, without
+        detecting again. Only the heatmap and blob settings apply.
+        :param points: (N, 2) array of keypoint coordinates on the processing scale.
+        :param shape: shape of the frame on the processing scale.
+        :return: (N, 4) array of center x, center y, w, h in full resolution pixels
+        """
+        self.kp_frame = points
+        with metrics.timer("heatmap"):
+            heatmap = self._create_heatmap(shape)
+        # areas are measured on the processing scale
+        area_scale = self.scale ** 2
+        with metrics.timer("blobs"):
+            _, _, stats, _ = cv2.connectedComponentsWithStats(heatmap, connectivity=8)
+            # label 0 is the background
+            areas = stats[1:, cv2.CC_STAT_AREA]
+            keep = (areas > self.min_detection_area * area_scale) & (areas < self.max_detection_area * area_scale)
+            x, y, w, h = stats[1:][keep, :4].T
+            detections = np.column_stack([x + w // 2, y + h // 2, w, h])  # x, y, w, h
+        if self.scale != 1:
+            detections = np.round(detections / self.scale).astype(int)
         return detections
 
-    def _create_heatmap(self, image):
+    def _create_heatmap(self, shape):
         """
         Creates the heatmap.
-        :param image:
+        :param shape: shape of the frame on the processing scale.
         :return:
         """
-        heatmap = np.zeros(image.shape[:2], np.uint8)
-        for kp in self.kp_frame:
-            x, y = int(kp.pt[0]), int(kp.pt[1])
-            heatmap[y - self.heatmap_size:y + self.heatmap_size, x - self.heatmap_size:x + self.heatmap_size] += 1
-        heatmap[heatmap < self.min_hits] = 0
-        return heatmap
+        heatmap_size = max(int(round(self.heatmap_size * self.scale)), 1)
+        return keypoint_heatmap(self.kp_frame, shape, heatmap_size, self.min_hits)
 
 
 class ORBTracker:
     def __init__(self, prune_bg: bool = True, refresh_bg_frame: int = 10, heatmap_size: int = 20,
-                 min_hits: int = 3, min_track_length: int = 5, min_detection_area: int = 100, max_detection_area: int = 5000, refresh_frame_count: int = 1000):
+                 min_hits: int = 3, min_track_length: int = 5, min_detection_area: int = 100, max_detection_area: int = 5000, refresh_frame_count: int = 1000,
+                 max_distance: float = 50, motion_model: bool = False, scale: float = 1.0, grayscale: bool = False,
+                 roi=None, n_features: int = 500, tiles=(1, 1), max_archived_tracks: int = 100000,
+                 motion_gate: bool = False):
         """
         Creates a ORBTracker object. prune_bg determines whether to prune the background keypoints and descriptors.
         refresh_bg_frame determines how often to refresh the background keypoints and descriptors.
         heatmap_size determines the size of the heatmap. heatmap_threshold determines the threshold for the heatmap.
         min_track_length determines the minimum length of a track.
+        Every refresh_frame_count frames the tracker is compacted: stale tracks are retired to the archive, the track
+        store shrinks to the active tracks and the archive keeps its newest max_archived_tracks records. The
+        background model, the active tracks and the frame and track id counters are kept, so ids are unique over
+        the whole recording.
+        max_distance is the gating distance in pixels between a track and a detection. motion_model predicts the
+        tracks with a constant velocity Kalman filter, matches and gates them by its uncertainty instead, see
+        HungarianTracker.score.
+        scale and grayscale set the processing resolution and color of the detector, roi, n_features, tiles and
+        motion_gate where and how it detects features, see ORBDetector.
 
         :param prune_bg:
         :param refresh_bg_frame:
         :param heatmap_size:
         :param min_track_length:
+        :param refresh_frame_count:
+        :param max_distance:
+        :param motion_model:
+        :param scale:
+        :param grayscale:
+        :param roi:
+        :param n_features:
+        :param tiles:
+        :param max_archived_tracks:
+        :param motion_gate:
         """
-        self.detections = []
+        self.detections = np.empty((0, 4), int)
         self.prune_bg = prune_bg
         self.refresh_bg_frame = refresh_bg_frame
         self.heatmap_size = heatmap_size
@@ -154,39 +309,63 @@ class ORBTracker:
         self.min_detection_area = min_detection_area
         self.max_detection_area = max_detection_area
         self.refresh_frame_count = refresh_frame_count
+        self.max_distance = max_distance
+        self.motion_model = motion_model
+        self.scale = scale
+        self.grayscale = grayscale
+        self.roi = load_roi(roi) if isinstance(roi, str) else roi
+        self.n_features = n_features
+        self.tiles = tiles
+        self.max_archived_tracks = max_archived_tracks
+        self.motion_gate = motion_gate
         self.n_frames = 0
-        self.orb_detector = ORBDetector(prune_bg, refresh_bg_frame, heatmap_size, min_hits=min_hits,
-                                        min_detection_area=min_detection_area, max_detection_area=max_detection_area)
-        self.tracker = HungarianTracker(n_history=50)
+        self.compacted_frame = 0
+        # whether the current detections were propagated from earlier ones instead of detected
+        self.propagated = False
+        self.orb_detector = self._create_detector()
+        self.tracker = HungarianTracker(n_history=50, max_distance=self.max_distance, motion_model=motion_model)
+        self.overlay = TrailOverlay()
+
+    def _create_detector(self):
+        """
+        Creates the ORBDetector with the tracker settings.
+        :return:
+        """
+        return ORBDetector(self.prune_bg, self.refresh_bg_frame, self.heatmap_size, min_hits=self.min_hits,
+                           min_detection_area=self.min_detection_area, max_detection_area=self.max_detection_area,
+                           scale=self.scale, grayscale=self.grayscale, roi=self.roi, n_features=self.n_features,
+                           tiles=self.tiles, motion_gate=self.motion_gate)
 
     def draw_tracks(self, image, draw_kp: bool = True, draw_detections: bool = True, draw_tracks: bool = True,
                     draw_numbers: bool = True):
         """
-        Draws the tracks on the image.
+        Draws the tracks on the image. The trails come from a persistent overlay layer which only draws the newest
+        segment of every track, see overlay.TrailOverlay.
         :param image:
         :return:
         """
-        if draw_kp:
-            cv2.drawKeypoints(image, self.orb_detector.get_frame_keypoints(), image, color=(0, 255, 0))
+        # a propagated frame has no keypoints of its own, the last ones would be drawn on the wrong frame
+        if draw_kp and not self.propagated:
+            keypoints = cv2.KeyPoint_convert(self.orb_detector.get_frame_keypoints())
+            cv2.drawKeypoints(image, keypoints, image, color=(0, 255, 0))
 
         if draw_detections:
             for detection in self.detections:
                 x, y, w, h = detection
                 cv2.rectangle(image, (x - w // 2, y - h // 2), (x + w // 2, y + h // 2), (0, 255, 0), 1)
 
-        for track in self.get_tracks():
-            if len(track.tracked_positions) < self.min_track_length:
-                continue
-            x, y, w, h = track.tracked_positions[-1].astype(int)
+        tracks = self.get_tracks()
+        if draw_tracks:
+            with metrics.timer("overlay"):
+                self.overlay.update(tracks, self.n_frames, image.shape, self.min_track_length)
+                self.overlay.blend(image)
+        slots = tracks.active_slots()
+        slots = slots[tracks.lengths[slots] >= self.min_track_length]
+        centers = np.round(tracks.last_bboxes(slots)[:, :2]).astype(int)
+        for track_id, (x, y) in zip(tracks.track_ids[slots], centers):
             if draw_numbers:
-                cv2.putText(image, str(track.track_id), (x, y), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 1)
+                cv2.putText(image, str(track_id), (x, y), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 1)
             cv2.circle(image, (x, y), 2, (0, 0, 220), -1)
-            if draw_tracks:
-                l = len(track.tracked_positions)
-                for i in range(l - 1):
-                    x1, y1, _, _ = track.tracked_positions[i].astype(int)
-                    x2, y2, _, _ = track.tracked_positions[i + 1].astype(int)
-                    cv2.line(image, (x1, y1), (x2, y2), (0, 120, 255 - (l - i) * 3), 1)
 
         return image
 
@@ -197,18 +376,71 @@ class ORBTracker:
         :return:
         """
         self.n_frames += 1
-        if self.orb_detector.n_frames % self.refresh_frame_count == 0:
-            self.orb_detector = ORBDetector(self.prune_bg, self.refresh_bg_frame, self.heatmap_size,
-                                            min_hits=self.min_hits,
-                                            min_detection_area=self.min_detection_area,
-                                            max_detection_area=self.max_detection_area)
-            self.tracker = HungarianTracker(n_history=50)
-            self.n_frames = 0
-        print("Tracking frame {}".format(self.n_frames), end="\r")
+        if self.n_frames - self.compacted_frame >= self.refresh_frame_count:
+            self.compact()
         self.detections = self.orb_detector.get_detections(image)
-        self.tracker.get_tracks(self.detections, self.n_frames)
+        self.propagated = False
+        return self._assign()
+
+    def replay(self, points, shape):
+        """
+        Tracks the detections of keypoints found earlier instead of detecting them, see
+        ORBDetector.detections_from_keypoints.
+        :param points: (N, 2) array of keypoint coordinates on the processing scale.
+        :param shape: shape of the frame on the processing scale.
+        :return:
+        """
+        self.n_frames += 1
+        if self.n_frames - self.compacted_frame >= self.refresh_frame_count:
+            self.compact()
+        self.detections = self.orb_detector.detections_from_keypoints(points, shape)
+        self.propagated = False
+        return self._assign()
+
+    def _assign(self):
+        """
+        Assigns the detections of the frame to the tracks.
+        :return:
+        """
+        with metrics.timer("assignment"):
+            self.tracker.get_tracks(self.detections, self.n_frames)
+        metrics.set_gauge("active_tracks", len(self.tracker.tracks))
+        return self.tracker.tracks
+
+    def compact(self):
+        """
+        Bounds the memory of the tracker without restarting it, see refresh_frame_count.
+        :return:
+        """
+        with metrics.timer("compaction"):
+            self.tracker.compact(self.n_frames)
+            self.tracker.tracks.archive.trim(self.max_archived_tracks)
+        self.compacted_frame = self.n_frames
+        metrics.increment("compactions")
+
+    def propagate(self, image=None):
+        """
+        Moves the tracks of the last detections to the next frame without running the detector, a cheap stand-in
+        for track on the frames between two detections. The detections are the predicted boxes with a motion
+        model and the last ones without it, and propagated is set so they aren't taken for real detections.
+        :param image: unused, the frame is only counted.
+        :return:
+        """
+        self.n_frames += 1
+        with metrics.timer("propagation"):
+            bboxes = self.tracker.propagate(self.n_frames)
+        self.detections = np.round(bboxes).astype(int)
+        self.propagated = True
         return self.tracker.tracks
 
+    def skip(self, n_frames: int):
+        """
+        Accounts for frames that were skipped, so the motion model and the track ages see the elapsed time.
+        :param n_frames:
+        :return:
+        """
+        self.n_frames += n_frames
+
     def get_tracks(self):
         """
         Gets the tracks.
@@ -222,3 +454,10 @@ class ORBTracker:
         :return:
         """
         return self.detections
+
+    def get_detection_ids(self):
+        """
+        Gets the track id of every detection of the last frame.
+        :return:
+        """
+        return self.tracker.detection_ids
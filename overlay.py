@@ -0,0 +1,61 @@
+import cv2
+import numpy as np
+
+
+class TrailOverlay:
+    def __init__(self, fade: int = 5, color=(0, 120, 255), thickness: int = 1):
+        """
+        Creates a TrailOverlay object, a persistent layer of track trails updated incrementally. Every frame the
+        layer fades by fade and only the newest segment of every updated track is drawn on it, all of them in one
+        polylines call. A track reaching the minimum length gets its whole kept trail drawn once. The layer is
+        added to the frame in one saturating add, so the cost doesn't grow with the length of the trails.
+        :param fade: intensity the trails lose per frame, older segments fade out after 255 / fade frames.
+        :param color: BGR color of the newest segments.
+        :param thickness: line thickness.
+        """
+        self.fade = fade
+        self.color = color
+        self.thickness = thickness
+        self.layer = None
+        self.frame_id = None
+
+    def update(self, tracks, frame_id: int, shape, min_track_length: int = 1):
+        """
+        Fades the layer and draws the segments of the tracks updated at frame_id.
+        :param tracks: track.TrackStore.
+        :param frame_id: current frame id, a frame already drawn is not drawn again.
+        :param shape: shape of the frames.
+        :param min_track_length: tracks shorter than this aren't drawn.
+        :return:
+        """
+        if self.layer is None or self.layer.shape != tuple(shape):
+            self.layer = np.zeros(shape, np.uint8)
+            self.frame_id = None
+        if frame_id == self.frame_id:
+            return
+        self.frame_id = frame_id
+        cv2.subtract(self.layer, (self.fade,) * 4, dst=self.layer)
+        slots = tracks.active_slots()
+        slots = slots[(tracks.last_frames[slots] == frame_id) & (tracks.lengths[slots] >= max(min_track_length, 2))]
+        if len(slots) == 0:
+            return
+        lengths = tracks.lengths[slots]
+        # the newest segment of every track, x, y of the last two positions
+        segments = np.stack([tracks.positions[slots, (lengths - 2) % tracks.history, :2],
+                             tracks.positions[slots, (lengths - 1) % tracks.history, :2]], axis=1)
+        polylines = list(np.round(segments).astype(np.int32))
+        # tracks that just became long enough were not drawn yet
+        if min_track_length > 2:
+            polylines += [np.round(tracks.trail(slot)[:-1, :2]).astype(np.int32)
+                          for slot in slots[lengths == min_track_length]]
+        cv2.polylines(self.layer, polylines, False, self.color, self.thickness)
+
+    def blend(self, image):
+        """
+        Adds the layer to the image in place.
+        :param image:
+        :return:
+        """
+        if self.layer is not None and self.layer.shape == image.shape:
+            cv2.add(image, self.layer, dst=image)
+        return image
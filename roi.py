@@ -0,0 +1,105 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+
+def load_roi(path: str):
+    """
+    Loads region of interest polygons from a JSON file such as {"polygons": [[[x, y], [x, y], ...], ...]}
+    in full resolution pixels. A bare list of polygons is accepted too.
+    :param path:
+    :return: list of (N, 2) int32 arrays
+    """
+    with open(path) as f:
+        config = json.load(f)
+    polygons = config["polygons"] if isinstance(config, dict) else config
+    return [np.asarray(polygon, np.int32).reshape(-1, 2) for polygon in polygons]
+
+
+def roi_mask(polygons, shape, scale: float = 1.0):
+    """
+    Rasterizes region of interest polygons into a detectAndCompute mask.
+    :param polygons: list of (N, 2) arrays in full resolution pixels.
+    :param shape: shape of the processed image.
+    :param scale: processing scale of the image.
+    :return: uint8 mask, 255 inside the polygons
+    """
+    mask = np.zeros(shape[:2], np.uint8)
+    cv2.fillPoly(mask, [np.round(np.asarray(p) * scale).astype(np.int32) for p in polygons], 255)
+    return mask
+
+
+class TiledORB:
+    def __init__(self, tiles=(2, 2), overlap: int = 32, n_features: int = 500, workers: int = None):
+        """
+        Creates a TiledORB object which detects ORB features tile by tile on a thread pool (OpenCV releases the GIL).
+        The region to detect in is split into a grid of core rectangles, every tile is its core grown by overlap
+        pixels so features near a seam have their full patch. Each tile has its own ORB with a share of the feature
+        budget, so busy tiles can't starve the others. A keypoint is kept only by the tile whose core contains it,
+        which removes the duplicates found in the overlaps.
+        :param tiles: number of tile rows and columns.
+        :param overlap: pixels added around every core, at least the ORB edge threshold (31).
+        :param n_features: feature budget shared by the tiles.
+        :param workers: number of threads, None uses one per tile.
+        """
+        self.tiles = tuple(tiles)
+        self.overlap = overlap
+        n_tiles = self.tiles[0] * self.tiles[1]
+        self.orbs = [cv2.ORB_create(nfeatures=max(n_features // n_tiles, 1)) for _ in range(n_tiles)]
+        self.executor = ThreadPoolExecutor(workers or n_tiles)
+
+    def _tile_bounds(self, shape, mask):
+        """
+        Splits the bounding box of the mask, the whole image without a mask, into tile cores and tiles.
+        :param shape:
+        :param mask:
+        :return: list of core and tile rectangles as x0, y0, x1, y1
+        """
+        height, width = shape[:2]
+        x, y, w, h = cv2.boundingRect(mask) if mask is not None else (0, 0, width, height)
+        rows, cols = self.tiles
+        ys = np.linspace(y, y + h, rows + 1).astype(int)
+        xs = np.linspace(x, x + w, cols + 1).astype(int)
+        bounds = []
+        for i in range(rows):
+            for j in range(cols):
+                core = (xs[j], ys[i], xs[j + 1], ys[i + 1])
+                tile = (max(core[0] - self.overlap, 0), max(core[1] - self.overlap, 0),
+                        min(core[2] + self.overlap, width), min(core[3] + self.overlap, height))
+                bounds.append((core, tile))
+        return bounds
+
+    def _detect_tile(self, orb, image, mask, core, tile):
+        """
+        Detects the features of one tile and keeps the ones inside its core.
+        :return: (N, 2) coordinates and (N, 32) descriptors
+        """
+        x0, y0, x1, y1 = tile
+        tile_mask = None if mask is None else mask[y0:y1, x0:x1]
+        if tile_mask is not None and not tile_mask.any():
+            return np.empty((0, 2), np.float32), None
+        keypoints, descriptors = orb.detectAndCompute(image[y0:y1, x0:x1], tile_mask)
+        if descriptors is None or len(keypoints) == 0:
+            return np.empty((0, 2), np.float32), None
+        points = np.asarray(cv2.KeyPoint_convert(keypoints), np.float32).reshape(-1, 2) + [x0, y0]
+        inside = ((points[:, 0] >= core[0]) & (points[:, 0] < core[2]) &
+                  (points[:, 1] >= core[1]) & (points[:, 1] < core[3]))
+        return points[inside], descriptors[inside]
+
+    def detect_and_compute(self, image, mask=None):
+        """
+        Detects the features of every tile in parallel and merges them.
+        :param image:
+        :param mask: optional detectAndCompute mask of the whole image.
+        :return: (N, 2) float32 coordinates and (N, 32) uint8 descriptors, None without features
+        """
+        futures = [self.executor.submit(self._detect_tile, orb, image, mask, core, tile)
+                   for orb, (core, tile) in zip(self.orbs, self._tile_bounds(image.shape, mask))]
+        results = [future.result() for future in futures]
+        descriptors = [d for _, d in results if d is not None and len(d)]
+        if not descriptors:
+            return np.empty((0, 2), np.float32), None
+        points = np.concatenate([p for p, d in results if d is not None and len(d)])
+        return points, np.ascontiguousarray(np.concatenate(descriptors))
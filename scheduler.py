@@ -0,0 +1,108 @@
+import math
+
+from metrics import metrics
+
+
+class AdaptiveScheduler:
+    def __init__(self, target_fps: float = 15.0, target_latency: float = 0.2, live: bool = True,
+                 source_fps: float = 30.0, max_detect_interval: int = 4, max_bg_slowdown: int = 8,
+                 smoothing: float = 0.2, max_skip: int = 30, settle_frames: int = 10):
+        """
+        Creates an AdaptiveScheduler object which keeps the tracking loop within a frame time and latency budget.
+        It watches the processing time of every frame through an exponential moving average and applies three
+        levers. Frames that piled up in the capture while a frame was processed are skipped for live sources, as
+        far as they exceed the latency budget. Under pressure full ORB detection only runs every k frames, the
+        frames in between propagate the tracks with their prediction, and the background keypoints are refreshed
+        less often. The levers move one step at a time, at most every settle_frames frames so the moving average
+        can follow, and are released once the frame time is well within the budget.
+        Every decision is counted in the metrics registry.
+        :param target_fps: processing rate to sustain, the frame time budget is its inverse.
+        :param target_latency: maximum age in seconds of the frame being processed, live sources only.
+        :param live: whether the source is a camera, recorded videos are never skipped.
+        :param source_fps: frame rate of the source, used to estimate the frames that piled up.
+        :param max_detect_interval: largest k, 1 detects on every frame.
+        :param max_bg_slowdown: largest factor applied to the background refresh interval.
+        :param smoothing: weight of the newest frame time in the moving average.
+        :param max_skip: maximum number of frames skipped at once.
+        :param settle_frames: number of frames between two changes of the levers.
+        """
+        self.budget = 1 / target_fps
+        self.target_latency = target_latency
+        self.live = live
+        self.source_fps = source_fps
+        self.max_detect_interval = max_detect_interval
+        self.max_bg_slowdown = max_bg_slowdown
+        self.smoothing = smoothing
+        self.max_skip = max_skip
+        self.settle_frames = settle_frames
+        self.frames_since_change = 0
+        self.frame_time = None
+        self.last_frame_time = 0.0
+        self.detect_interval = 1
+        self.bg_slowdown = 1
+        self.frames_since_detection = 0
+
+    def stale_frames(self):
+        """
+        Estimates the frames of a live source that are older than the latency budget, they should be skipped
+        before reading the next frame.
+        :return: number of frames to skip
+        """
+        if not self.live:
+            return 0
+        waiting = math.ceil(self.last_frame_time * self.source_fps) - 1
+        allowed = int(self.target_latency * self.source_fps)
+        return min(max(waiting - allowed, 0), self.max_skip)
+
+    def should_detect(self):
+        """
+        Decides whether the next frame runs the full detection or only propagates the tracks.
+        :return:
+        """
+        detect = self.frames_since_detection + 1 >= self.detect_interval
+        self.frames_since_detection = 0 if detect else self.frames_since_detection + 1
+        metrics.increment("scheduler_detected_frames" if detect else "scheduler_propagated_frames")
+        return detect
+
+    def bg_refresh(self, refresh_bg_frame: int):
+        """
+        Gets the background keypoint refresh interval under the current load.
+        :param refresh_bg_frame: configured refresh interval.
+        :return:
+        """
+        return refresh_bg_frame * self.bg_slowdown
+
+    def record(self, seconds: float):
+        """
+        Records the processing time of a frame and adapts the levers. Above the budget the detection interval
+        grows first and the background refresh slows down once detection is decimated as far as it goes,
+        below 70 % of the budget they are released in the opposite order.
+        :param seconds: processing time of the frame.
+        :return:
+        """
+        self.last_frame_time = seconds
+        if self.frame_time is None:
+            self.frame_time = seconds
+        else:
+            self.frame_time += self.smoothing * (seconds - self.frame_time)
+        self.frames_since_change += 1
+        metrics.set_gauge("scheduler_frame_seconds", self.frame_time)
+        if self.frames_since_change < self.settle_frames:
+            return
+        levers = self.detect_interval, self.bg_slowdown
+        if self.frame_time > self.budget:
+            if self.detect_interval < self.max_detect_interval:
+                self.detect_interval += 1
+                metrics.increment("scheduler_decimation_increases")
+            elif self.bg_slowdown < self.max_bg_slowdown:
+                self.bg_slowdown *= 2
+                metrics.increment("scheduler_bg_slowdowns")
+        elif self.frame_time < 0.7 * self.budget:
+            if self.bg_slowdown > 1:
+                self.bg_slowdown //= 2
+            elif self.detect_interval > 1:
+                self.detect_interval -= 1
+        if (self.detect_interval, self.bg_slowdown) != levers:
+            self.frames_since_change = 0
+        metrics.set_gauge("scheduler_detect_interval", self.detect_interval)
+        metrics.set_gauge("scheduler_bg_slowdown", self.bg_slowdown)
@@ -0,0 +1,289 @@
+import json
+import os
+import queue
+import time
+from threading import Thread
+
+import numpy as np
+
+_STOP = object()
+
+COLUMNS = ("frame", "track_id", "x", "y", "w", "h")
+COLUMN_DTYPES = {"frame": np.int64, "track_id": np.int64, "x": np.float32, "y": np.float32, "w": np.float32,
+                 "h": np.float32}
+
+
+class DetectionSink:
+    def __init__(self, path: str = "bboxes.csv", batch_size: int = 512, flush_interval: float = 1.0,
+                 queue_size: int = 256):
+        """
+        Creates a DetectionSink object which appends detections to a tab separated file in the YOLO layout
+        frame, class, x, y, w, h. The file stays open and rows are formatted and written in batches by a background
+        thread, so the capture thread only pays for a queue put. A batch is written once it holds batch_size rows
+        or flush_interval seconds have passed since the last write.
+        :param path: path of the detections file.
+        :param batch_size: number of rows buffered before they are written.
+        :param flush_interval: maximum number of seconds rows stay buffered.
+        :param queue_size: maximum number of frames waiting for the writer, write blocks when it is full.
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._open()
+        self.closed = False
+        # exception that stopped the writer thread, raised again by write and close
+        self.error = None
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _open(self):
+        """
+        Opens the detections file.
+        :return:
+        """
+        self.file = open(self.path, "a")
+
+    def write(self, frame_id: int, bboxes, track_ids=None):
+        """
+        Queues the normalized bounding boxes of a frame.
+        :param frame_id: frame number.
+        :param bboxes: (N, 4) array of normalized x, y, w, h.
+        :param track_ids: optional track id of every bounding box, -1 when unknown.
+        :return:
+        """
+        if self.closed:
+            raise ValueError("write to a closed DetectionSink")
+        bboxes = np.asarray(bboxes, float).reshape(-1, 4)
+        if len(bboxes) == 0:
+            return
+        track_ids = np.full(len(bboxes), -1) if track_ids is None else np.asarray(track_ids).reshape(-1)
+        self._put((frame_id, bboxes, track_ids))
+
+    def _check_writer(self):
+        """
+        Raises the exception that stopped the writer thread, e.g. a full disk.
+        :return:
+        """
+        if self.error is not None:
+            raise self.error
+        if not self.thread.is_alive():
+            raise RuntimeError("the DetectionSink writer thread stopped")
+
+    def _put(self, item):
+        """
+        Queues an item for the writer thread, waiting while the queue is full but not on a failed writer.
+        :param item:
+        :return:
+        """
+        while True:
+            self._check_writer()
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _write_batch(self, batch):
+        """
+        Formats the rows of the buffered frames and writes them with a single write call.
+        :param batch: list of frame id, bboxes, track ids tuples.
+        :return:
+        """
+        rows = [f"{frame_id}\t0\t{x}\t{y}\t{w}\t{h}\n" for frame_id, bboxes, _ in batch for x, y, w, h in bboxes.tolist()]
+        self.file.write("".join(rows))
+        self.file.flush()
+
+    def _close(self):
+        """
+        Closes the detections file.
+        :return:
+        """
+        self.file.close()
+
+    def _run(self):
+        """
+        Writer thread, stores the exception it fails with for write and close.
+        :return:
+        """
+        try:
+            self._write_loop()
+        except Exception as e:
+            self.error = e
+
+    def _write_loop(self):
+        """
+        Writer loop, batches queued frames until the sink is closed.
+        :return:
+        """
+        batch, n_rows = [], 0
+        last_flush = time.monotonic()
+        while True:
+            timeout = max(self.flush_interval - (time.monotonic() - last_flush), 0.01)
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                break
+            if item is not None:
+                batch.append(item)
+                n_rows += len(item[1])
+            if n_rows >= self.batch_size or time.monotonic() - last_flush >= self.flush_interval:
+                if batch:
+                    self._write_batch(batch)
+                batch, n_rows = [], 0
+                last_flush = time.monotonic()
+        if batch:
+            self._write_batch(batch)
+
+    def close(self):
+        """
+        Stops the writer thread after it wrote every queued frame and closes the file. Raises the exception of
+        a failed writer thread, the file is closed anyway.
+        :return:
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._put(_STOP)
+            self.thread.join()
+            if self.error is not None:
+                raise self.error
+        finally:
+            self._close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ColumnarDetectionSink(DetectionSink):
+    def __init__(self, path: str = "bboxes", batch_size: int = 65536, flush_interval: float = 30.0,
+                 queue_size: int = 256):
+        """
+        Creates a ColumnarDetectionSink object which writes detections and track ids into a directory of binary
+        column segments. Every written batch becomes one segment with a .npy file per column (see COLUMNS) and
+        index.json lists the frame range of every segment, so a frame range can be memory mapped and sliced with
+        DetectionReader without parsing the whole recording. Appending to an existing directory adds segments.
+        :param path: directory of the segments.
+        :param batch_size: number of rows per segment.
+        :param flush_interval: maximum number of seconds rows stay buffered.
+        :param queue_size: maximum number of frames waiting for the writer, write blocks when it is full.
+        """
+        super().__init__(path, batch_size, flush_interval, queue_size)
+
+    def _open(self):
+        """
+        Creates the segment directory and loads its index.
+        :return:
+        """
+        os.makedirs(self.path, exist_ok=True)
+        self.index = read_index(self.path)
+
+    def _write_batch(self, batch):
+        """
+        Writes the buffered frames as one segment and updates the index.
+        :param batch: list of frame id, bboxes, track ids tuples.
+        :return:
+        """
+        bboxes = np.concatenate([b for _, b, _ in batch])
+        columns = {"frame": np.concatenate([np.full(len(b), f) for f, b, _ in batch]),
+                   "track_id": np.concatenate([t for _, _, t in batch]),
+                   "x": bboxes[:, 0], "y": bboxes[:, 1], "w": bboxes[:, 2], "h": bboxes[:, 3]}
+        segment = len(self.index)
+        for name in COLUMNS:
+            np.save(_column_path(self.path, name, segment), columns[name].astype(COLUMN_DTYPES[name]))
+        self.index.append({"segment": segment, "first_frame": int(columns["frame"][0]),
+                           "last_frame": int(columns["frame"][-1]), "rows": len(bboxes)})
+        # the index is replaced atomically so a reader never sees a half written one
+        tmp_path = os.path.join(self.path, "index.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, os.path.join(self.path, "index.json"))
+
+    def _close(self):
+        return
+
+
+def _column_path(path: str, name: str, segment: int):
+    return os.path.join(path, f"{name}_{segment:06d}.npy")
+
+
+def read_index(path: str):
+    """
+    Reads the segment index of a columnar detections directory.
+    :param path: directory of the segments.
+    :return: list of segment, first_frame, last_frame, rows dictionaries
+    """
+    index_path = os.path.join(path, "index.json")
+    if not os.path.isfile(index_path):
+        return []
+    with open(index_path) as f:
+        return json.load(f)
+
+
+class DetectionReader:
+    def __init__(self, path: str):
+        """
+        Creates a DetectionReader object over a directory written by ColumnarDetectionSink.
+        Segments are memory mapped on demand, so only the pages of the requested frames are read.
+        :param path: directory of the segments.
+        """
+        self.path = path
+        self.index = read_index(path)
+
+    def __len__(self):
+        return sum(entry["rows"] for entry in self.index)
+
+    def _column(self, name: str, segment: int):
+        return np.load(_column_path(self.path, name, segment), mmap_mode="r")
+
+    def segments(self, columns=COLUMNS):
+        """
+        Iterates over the segments in the order they were written.
+        :param columns: names of the columns to read.
+        :return: generator of dictionaries of memory mapped column arrays
+        """
+        for entry in self.index:
+            yield {name: self._column(name, entry["segment"]) for name in columns}
+
+    def read(self, start_frame: int = None, stop_frame: int = None, columns=COLUMNS):
+        """
+        Reads the detections with start_frame <= frame < stop_frame. Frames are sorted within a segment, so the rows
+        are located with a binary search on the memory mapped frame column.
+        :param start_frame: first frame, None reads from the beginning.
+        :param stop_frame: frame after the last one, None reads until the end.
+        :param columns: names of the columns to read.
+        :return: dictionary of column arrays
+        """
+        parts = {name: [] for name in columns}
+        for entry in self.index:
+            if start_frame is not None and entry["last_frame"] < start_frame:
+                continue
+            if stop_frame is not None and entry["first_frame"] >= stop_frame:
+                continue
+            frames = self._column("frame", entry["segment"])
+            lo = 0 if start_frame is None else np.searchsorted(frames, start_frame, "left")
+            hi = len(frames) if stop_frame is None else np.searchsorted(frames, stop_frame, "left")
+            for name in columns:
+                parts[name].append(self._column(name, entry["segment"])[lo:hi])
+        return {name: np.concatenate(parts[name]) if parts[name] else np.empty(0, COLUMN_DTYPES[name])
+                for name in columns}
+
+
+def open_sink(path: str, output_format: str = "csv"):
+    """
+    Opens a detection sink for the given output format.
+    :param path: file for csv, directory for npy.
+    :param output_format: csv for the YOLO text file, npy for binary column segments.
+    :return:
+    """
+    if output_format == "csv":
+        return DetectionSink(path)
+    if output_format == "npy":
+        return ColumnarDetectionSink(path)
+    raise ValueError(f"unknown detections format {output_format}")
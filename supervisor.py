@@ -0,0 +1,325 @@
+import argparse
+import multiprocessing as mp
+import os
+import time
+from multiprocessing import shared_memory
+from threading import Lock, Thread
+
+import cv2
+import numpy as np
+
+from encoder import StreamEncoder
+from hub import FrameBroadcast
+from metrics import metrics
+from sink import open_sink
+
+# header of a ring: published frame count, then one sequence number per slot
+HEADER_SLOTS = 1
+
+
+class FrameRing:
+    def __init__(self, shape, n_slots: int = 3, name: str = None, create: bool = False):
+        """
+        Creates a FrameRing object, a ring of frames in shared memory written by one process and read by any number
+        of others without copying or pickling them. Every slot is guarded by a sequence lock: the writer makes the
+        slot sequence odd while it fills the slot and even again when it publishes it, a reader checks that the
+        sequence is even and unchanged around its use of the slot and retries otherwise. Readers always get the
+        newest published frame, the ring only needs enough slots to cover the writer lapping a slow reader.
+        :param shape: frame shape.
+        :param n_slots: number of frames in the ring.
+        :param name: shared memory block name, None lets the system choose one when creating.
+        :param create: whether to create the block, the creating process unlinks it.
+        """
+        self.shape = tuple(shape)
+        self.n_slots = n_slots
+        frame_size = int(np.prod(self.shape))
+        header_size = 8 * (HEADER_SLOTS + n_slots)
+        self.create = create
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=header_size + n_slots * frame_size)
+        self.name = self.shm.name
+        self.header = np.ndarray(HEADER_SLOTS + n_slots, np.int64, self.shm.buf)
+        self.slot_sequences = self.header[HEADER_SLOTS:]
+        self.frames = np.ndarray((n_slots,) + self.shape, np.uint8, self.shm.buf, offset=header_size)
+        if create:
+            self.header[:] = 0
+
+    @property
+    def sequence(self):
+        """
+        Number of frames published so far.
+        :return:
+        """
+        return int(self.header[0])
+
+    def begin(self):
+        """
+        Claims the next slot for writing.
+        :return: slot index and the writable frame of the slot
+        """
+        slot = self.sequence % self.n_slots
+        self.slot_sequences[slot] += 1
+        return slot, self.frames[slot]
+
+    def release_slots(self):
+        """
+        Gives back the slots a previous writer claimed and never published, e.g. because it died in between.
+        An odd slot sequence would otherwise make readers skip the slot forever. Only the writer calls it, before
+        it writes.
+        :return:
+        """
+        odd = self.slot_sequences % 2 == 1
+        self.slot_sequences[odd] += 1
+
+    def publish(self, slot: int):
+        """
+        Publishes a slot claimed by begin.
+        :param slot:
+        :return:
+        """
+        self.slot_sequences[slot] += 1
+        self.header[0] += 1
+
+    def abort(self, slot: int):
+        """
+        Gives back a slot claimed by begin without publishing it.
+        :param slot:
+        :return:
+        """
+        self.slot_sequences[slot] += 1
+
+    def read(self, consume, last: int = 0):
+        """
+        Calls consume with the newest published frame if it is newer than last. The frame is a view of the shared
+        memory, consume must not keep it: its result is discarded and consume called again when the writer
+        overwrote the slot meanwhile.
+        :param consume: callable(frame) such as a JPEG encoder.
+        :param last: sequence of the frame the caller has already seen.
+        :return: sequence of the frame and the result of consume, None when there is no new frame
+        """
+        while True:
+            sequence = self.sequence
+            if sequence == last:
+                return last, None
+            slot = (sequence - 1) % self.n_slots
+            before = self.slot_sequences[slot]
+            if before % 2 == 0:
+                result = consume(self.frames[slot])
+                if self.slot_sequences[slot] == before:
+                    return sequence, result
+            metrics.increment("ring_torn_reads")
+
+    def close(self):
+        """
+        Detaches from the shared memory, unlinking it when this ring created it.
+        :return:
+        """
+        # drop the views before closing the buffer
+        self.header = self.slot_sequences = self.frames = None
+        self.shm.close()
+        if self.create:
+            self.shm.unlink()
+
+
+def camera_worker(camera_id: str, source, ring_names: dict, shape, n_slots: int, stop, tracker_kwargs: dict = None,
+                  bbox_path: str = None, bbox_format: str = "npy"):
+    """
+    Captures, detects, tracks and draws one camera in its own process. Frames are read straight into a slot of the
+    index ring and tracked there, the annotated copy is drawn in a slot of the track ring. A video ends the worker
+    cleanly at its end, a camera that fails to deliver a frame is an error so the supervisor restarts the worker.
+    :param camera_id:
+    :param source: camera index or video path.
+    :param ring_names: video type to shared memory name of its ring.
+    :param shape: frame shape of the rings, frames of another size are resized.
+    :param n_slots: number of slots of the rings.
+    :param stop: event ending the worker.
+    :param tracker_kwargs: arguments of the ORBTracker.
+    :param bbox_path: optional detections file of the camera, see sink.open_sink.
+    :param bbox_format:
+    :return:
+    """
+    from orb_detector import ORBTracker
+
+    rings = {video_type: FrameRing(shape, n_slots, name) for video_type, name in ring_names.items()}
+    # a previous worker of this camera may have died while writing a slot
+    for ring in rings.values():
+        ring.release_slots()
+    cap = cv2.VideoCapture(source)
+    height, width = shape[:2]
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+    tracker = ORBTracker(**dict({"heatmap_size": 10}, **(tracker_kwargs or {})))
+    sink = open_sink(bbox_path, bbox_format) if bbox_path else None
+    n_frames = 0
+    try:
+        while not stop.is_set():
+            slot, frame = rings["index"].begin()
+            ret, captured = cap.read(frame)
+            if not ret:
+                rings["index"].abort(slot)
+                if isinstance(source, int):
+                    raise Exception(f"couldn't grab image frame from camera {source}")
+                break
+            if not np.shares_memory(captured, frame):
+                # the capture allocated its own frame, e.g. another resolution than asked for
+                if captured.shape == frame.shape:
+                    np.copyto(frame, captured)
+                else:
+                    cv2.resize(captured, (width, height), dst=frame, interpolation=cv2.INTER_AREA)
+            rings["index"].publish(slot)
+            n_frames += 1
+            tracker.track(frame)
+            if sink is not None:
+                bboxes = np.asarray(tracker.get_detections(), float).reshape(-1, 4)
+                sink.write(n_frames, bboxes / [width, height, width, height], tracker.get_detection_ids())
+            if "track" in rings:
+                slot, annotated = rings["track"].begin()
+                np.copyto(annotated, frame)
+                tracker.draw_tracks(annotated, draw_kp=True, draw_detections=False)
+                rings["track"].publish(slot)
+    finally:
+        if sink is not None:
+            sink.close()
+        cap.release()
+        for ring in rings.values():
+            ring.close()
+
+
+class CameraSupervisor:
+    def __init__(self, sources: dict, height: int = 720, width: int = 1280, n_slots: int = 3,
+                 tracker_kwargs: dict = None, bbox_dir: str = None, video_types=("index", "track"),
+                 restart_interval: float = 1.0, stream_width: int = 640, stream_quality: int = 80):
+        """
+        Creates a CameraSupervisor object which runs every camera in its own worker process, so capture, ORB,
+        tracking and drawing of different cameras run on different cores. The supervisor owns the shared memory
+        rings of the workers, restarts the workers that died and serves the rings as JPEG streams, encoded once
+        per frame whatever the number of viewers.
+        :param sources: camera id to camera index or video path.
+        :param height: frame height of the rings.
+        :param width: frame width of the rings.
+        :param n_slots: number of slots of every ring.
+        :param tracker_kwargs: arguments of the ORBTracker of every worker.
+        :param bbox_dir: optional directory of per camera detection files.
+        :param video_types: rings of every camera, index for the captured frames and track for the annotated ones.
+        :param restart_interval: seconds between two checks of the workers.
+        :param stream_width: width of the streams, None streams at the ring resolution.
+        :param stream_quality: highest JPEG quality of the streams, see encoder.StreamEncoder.
+        """
+        self.sources = {str(camera_id): source for camera_id, source in sources.items()}
+        self.shape = (height, width, 3)
+        self.n_slots = n_slots
+        self.tracker_kwargs = tracker_kwargs
+        self.bbox_dir = bbox_dir
+        self.video_types = tuple(video_types)
+        self.restart_interval = restart_interval
+        self.stream_width = stream_width
+        self.stream_quality = stream_quality
+        self.context = mp.get_context("spawn")
+        self.stop_event = self.context.Event()
+        self.rings = {}
+        self.workers = {}
+        self.broadcasts = {}
+        self.lock = Lock()
+        self.monitor = None
+
+    def _start_worker(self, camera_id: str):
+        """
+        Starts the worker process of a camera.
+        :param camera_id:
+        :return:
+        """
+        ring_names = {video_type: self.rings[camera_id, video_type].name for video_type in self.video_types}
+        bbox_path = os.path.join(self.bbox_dir, f"camera_{camera_id}") if self.bbox_dir else None
+        worker = self.context.Process(target=camera_worker, name=f"camera-{camera_id}", daemon=True,
+                                      args=(camera_id, self.sources[camera_id], ring_names, self.shape, self.n_slots,
+                                            self.stop_event, self.tracker_kwargs, bbox_path))
+        worker.start()
+        self.workers[camera_id] = worker
+        metrics.increment("worker_starts")
+
+    def start(self):
+        """
+        Creates the rings and starts the workers.
+        :return: self
+        """
+        if self.bbox_dir:
+            os.makedirs(self.bbox_dir, exist_ok=True)
+        for camera_id in self.sources:
+            for video_type in self.video_types:
+                self.rings[camera_id, video_type] = FrameRing(self.shape, self.n_slots, create=True)
+            self._start_worker(camera_id)
+        self.monitor = Thread(target=self._monitor, daemon=True)
+        self.monitor.start()
+        return self
+
+    def _monitor(self):
+        """
+        Restarts the workers that failed, including a camera that stopped delivering frames, a worker that reached
+        the end of its video exits cleanly and is left.
+        :return:
+        """
+        while not self.stop_event.wait(self.restart_interval):
+            for camera_id, worker in list(self.workers.items()):
+                if not worker.is_alive() and worker.exitcode != 0:
+                    print(f"camera {camera_id} worker exited with {worker.exitcode}, restarting")
+                    self._start_worker(camera_id)
+            for (camera_id, video_type), ring in self.rings.items():
+                if video_type == "index":
+                    metrics.set_gauge(f"camera_{camera_id}_frames", ring.sequence)
+
+    def stream(self, camera_id: str, video_type: str, poll_interval: float = 0.005):
+        """
+        Subscribes to the JPEG stream of a camera ring.
+        :param camera_id:
+        :param video_type:
+        :param poll_interval: seconds between two checks of the ring for a new frame.
+        :return: generator of encoded frames
+        """
+        key = (str(camera_id), video_type)
+        ring = self.rings[key]
+        with self.lock:
+            if key not in self.broadcasts:
+                last = [0]
+                encoder = StreamEncoder(self.stream_quality, self.stream_width)
+
+                def produce():
+                    while True:
+                        sequence, jpg = ring.read(encoder.encode, last[0])
+                        if jpg is not None:
+                            last[0] = sequence
+                            return jpg
+                        time.sleep(poll_interval)
+
+                self.broadcasts[key] = FrameBroadcast(produce, on_lag=encoder.viewer_lag)
+        return self.broadcasts[key].subscribe()
+
+    def stop(self):
+        """
+        Stops the workers and releases the rings.
+        :return:
+        """
+        self.stop_event.set()
+        for worker in self.workers.values():
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        for ring in self.rings.values():
+            ring.close()
+        self.rings.clear()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve several cameras, each tracked in its own process.")
+    parser.add_argument("sources", nargs="+", help="camera indices or video paths, the camera ids are 0, 1, ...")
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--bbox-dir", default=None, help="write the detections of every camera to this directory")
+    parser.add_argument("--port", type=int, default=5000)
+    args = parser.parse_args()
+    import app
+
+    sources = {str(i): int(source) if source.isdigit() else source for i, source in enumerate(args.sources)}
+    app.supervisor = CameraSupervisor(sources, args.height, args.width, bbox_dir=args.bbox_dir).start()
+    try:
+        app.app.run(debug=False, host='0.0.0.0', port=args.port, threaded=True)
+    finally:
+        app.supervisor.stop()
@@ -0,0 +1,268 @@
+import argparse
+import itertools
+import json
+import os
+import re
+import time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from cache import KEYPOINT_PARAMS, REPLAYED_STAGES, DetectionCache, track_video
+from metrics import metrics
+from track import linear_sum_assignment
+
+
+def load_labels(labels_dir: str, frame_offset: int = -1, frames=None):
+    """
+    Loads reference YOLO labels, one frame_XXXXXX.txt file of class, x, y, w, h rows per frame as written by
+    main.yolo_writer. main.yolo_writer doesn't write a file for a frame without detections, so the evaluated
+    frames should be given: the ones without a label file are frames without bees. Without frames only the frames
+    with a label file are evaluated, which leaves out every false positive on a frame without bees.
+    :param labels_dir:
+    :param frame_offset: label file number minus the 1 based frame number.
+    :param frames: frame numbers to evaluate, e.g. a range or see read_frame_list. None evaluates the label files.
+    :return: dictionary of frame number to (N, 4) array of normalized center x, center y, w, h
+    """
+    labels = {}
+    for name in os.listdir(labels_dir):
+        match = re.fullmatch(r"frame_(\d+)\.txt", name)
+        if match is None:
+            continue
+        with open(os.path.join(labels_dir, name)) as f:
+            rows = [line.split() for line in f if line.strip()]
+        boxes = np.array([[float(v) for v in row[1:5]] for row in rows]).reshape(-1, 4)
+        labels[int(match.group(1)) - frame_offset] = boxes
+    if frames is None:
+        return labels
+    return {frame: labels.get(frame, np.empty((0, 4))) for frame in frames}
+
+
+def read_frame_list(path: str, frame_offset: int = -1):
+    """
+    Reads the frame numbers of a YOLO image list such as the train.txt of a CVAT export, one
+    data/obj_train_data/frame_XXXXXX.PNG path per line.
+    :param path:
+    :param frame_offset: see load_labels.
+    :return: sorted list of frame numbers
+    """
+    frames = set()
+    with open(path) as f:
+        for line in f:
+            match = re.search(r"frame_(\d+)\.\w+$", line.strip())
+            if match is not None:
+                frames.add(int(match.group(1)) - frame_offset)
+    return sorted(frames)
+
+
+def box_iou(a, b):
+    """
+    Computes the intersection over union of every pair of center x, center y, w, h boxes.
+    :param a: (N, 4) array.
+    :param b: (M, 4) array.
+    :return: (N, M) array
+    """
+    a, b = np.asarray(a, float).reshape(-1, 4), np.asarray(b, float).reshape(-1, 4)
+    a_lo, a_hi = a[:, None, :2] - a[:, None, 2:] / 2, a[:, None, :2] + a[:, None, 2:] / 2
+    b_lo, b_hi = b[None, :, :2] - b[None, :, 2:] / 2, b[None, :, :2] + b[None, :, 2:] / 2
+    overlap = np.clip(np.minimum(a_hi, b_hi) - np.maximum(a_lo, b_lo), 0, None).prod(axis=2)
+    union = a[:, None, 2:].prod(axis=2) + b[None, :, 2:].prod(axis=2) - overlap
+    return np.divide(overlap, union, out=np.zeros_like(overlap), where=union > 0)
+
+
+def match_boxes(a, b, iou_threshold: float):
+    """
+    Matches two sets of boxes one to one maximizing the total IoU, pairs below iou_threshold are not matched.
+    :return: indices into a and b of the matched pairs
+    """
+    iou = box_iou(a, b)
+    if iou.size == 0:
+        return np.empty(0, int), np.empty(0, int)
+    rows, cols = linear_sum_assignment(-iou)
+    keep = iou[rows, cols] >= iou_threshold
+    return rows[keep], cols[keep]
+
+
+def gt_pseudo_tracks(labels: dict, iou_threshold: float = 0.3):
+    """
+    Links the reference boxes of consecutive frames into pseudo tracks, the labels have no identities.
+    :param labels: see load_labels.
+    :param iou_threshold: minimum IoU between the boxes of a bee in two consecutive frames.
+    :return: dictionary of frame number to the pseudo track id of every box
+    """
+    ids, next_id, previous_frame = {}, 0, None
+    for frame in sorted(labels):
+        boxes = labels[frame]
+        frame_ids = np.full(len(boxes), -1, np.int64)
+        if previous_frame == frame - 1:
+            rows, cols = match_boxes(labels[previous_frame], boxes, iou_threshold)
+            frame_ids[cols] = ids[previous_frame][rows]
+        new = frame_ids < 0
+        frame_ids[new] = np.arange(next_id, next_id + new.sum())
+        next_id += int(new.sum())
+        ids[frame] = frame_ids
+        previous_frame = frame
+    return ids
+
+
+def score_tracks(predictions: dict, labels: dict, iou_threshold: float = 0.5):
+    """
+    Scores tracked detections against reference labels. A detection matching a reference box with at least
+    iou_threshold IoU is a true positive. An identity switch is counted when the track matched to a reference
+    pseudo track differs from the one matched last time.
+    :param predictions: dictionary of frame number to normalized boxes and track ids.
+    :param labels: see load_labels.
+    :param iou_threshold:
+    :return: dictionary of precision, recall, f1 and id switches
+    """
+    gt_ids = gt_pseudo_tracks(labels)
+    tp = fp = fn = switches = 0
+    last_match = {}
+    for frame in sorted(labels):
+        gt_boxes = labels[frame]
+        boxes, track_ids = predictions.get(frame, (np.empty((0, 4)), np.empty(0, np.int64)))
+        rows, cols = match_boxes(gt_boxes, boxes, iou_threshold)
+        tp += len(rows)
+        fn += len(gt_boxes) - len(rows)
+        fp += len(boxes) - len(cols)
+        for gt_id, track_id in zip(gt_ids[frame][rows], track_ids[cols]):
+            if gt_id in last_match and last_match[gt_id] != track_id:
+                switches += 1
+            last_match[gt_id] = track_id
+    precision = tp / max(tp + fp, 1)
+    recall = tp / max(tp + fn, 1)
+    return {"precision": precision, "recall": recall,
+            "f1": 2 * precision * recall / max(precision + recall, 1e-12), "id_switches": switches,
+            "true_positives": tp, "false_positives": fp, "false_negatives": fn}
+
+
+def evaluate(video_path: str, params: dict, labels_dir: str, cache_dir: str, frame_offset: int = -1,
+             iou_threshold: float = 0.5, frames=None):
+    """
+    Tracks a video with one configuration and scores it, in a worker process. Keypoints are replayed from the
+    cache when a configuration with the same keypoint settings ran before. The per frame cost is the one of a
+    live run: the keypoint cost measured when the keypoints were detected plus the heatmap, blob and tracking
+    cost of this run.
+    :param video_path:
+    :param params: arguments of the ORBTracker.
+    :param labels_dir: directory of the reference labels.
+    :param cache_dir: directory of the keypoint cache shared by the workers.
+    :param frame_offset: see load_labels.
+    :param iou_threshold:
+    :param frames: frame numbers to evaluate, see load_labels.
+    :return: dictionary with the parameters, the scores and the timings
+    """
+    metrics.reset()
+    labels = load_labels(labels_dir, frame_offset, frames)
+    predictions = {}
+    start = time.perf_counter()
+    n_frames = 0
+    for frame, shape, detections, track_ids in track_video(video_path, DetectionCache(cache_dir), params):
+        height, width = shape[:2]
+        if frame in labels:
+            predictions[frame] = (np.asarray(detections, float).reshape(-1, 4) / [width, height, width, height],
+                                  np.array(track_ids))
+        n_frames = frame
+    seconds = time.perf_counter() - start
+    keypoint_ms = metrics.gauges.get("keypoint_ms_per_frame", float("nan"))
+    downstream_ms = 1000 * sum(metrics.sums.get(stage, 0.0) for stage in REPLAYED_STAGES) / max(n_frames, 1)
+    result = {"params": params, "frames": n_frames, "replayed": metrics.counters.get("keypoint_cache_hits", 0) > 0,
+              "ms_per_frame": keypoint_ms + downstream_ms, "keypoint_ms_per_frame": keypoint_ms,
+              "downstream_ms_per_frame": downstream_ms, "run_ms_per_frame": 1000 * seconds / max(n_frames, 1)}
+    result.update(score_tracks(predictions, labels, iou_threshold))
+    return result
+
+
+def parameter_grid(grid: dict):
+    """
+    Expands a grid of parameter name to list of values into every combination.
+    :param grid:
+    :return: list of parameter dictionaries
+    """
+    names = sorted(grid)
+    values = [grid[name] if isinstance(grid[name], list) else [grid[name]] for name in names]
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+def sweep(video_path: str, labels_dir: str, grid: dict, workers: int = None, cache_dir: str = "cache",
+          frame_offset: int = -1, iou_threshold: float = 0.5, frames=None):
+    """
+    Evaluates every configuration of a parameter grid on a process pool. Configurations are grouped by their
+    keypoint settings: the first one of a group decodes the video and fills the keypoint cache, the others start
+    once it finished and replay the keypoints, so every group decodes the video once at most.
+    :param video_path:
+    :param labels_dir: directory of the reference YOLO labels.
+    :param grid: parameter name to list of values, see parameter_grid.
+    :param workers: number of processes, None uses every core.
+    :param cache_dir: directory of the keypoint cache.
+    :param frame_offset: see load_labels.
+    :param iou_threshold: minimum IoU of a true positive.
+    :param frames: frame numbers to evaluate, see load_labels.
+    :return: list of results sorted by per frame cost
+    """
+    groups = defaultdict(list)
+    for params in parameter_grid(grid):
+        keypoint_params = {name: params[name] for name in KEYPOINT_PARAMS if name in params}
+        groups[json.dumps(keypoint_params, sort_keys=True)].append(params)
+    results, started, group_of = [], set(), {}
+    with ProcessPoolExecutor(workers) as executor:
+        pending = set()
+        for key, configurations in groups.items():
+            future = executor.submit(evaluate, video_path, configurations[0], labels_dir, cache_dir, frame_offset,
+                                     iou_threshold, frames)
+            group_of[future] = key
+            pending.add(future)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                results.append(future.result())
+                key = group_of[future]
+                if key not in started:
+                    started.add(key)
+                    for params in groups[key][1:]:
+                        follower = executor.submit(evaluate, video_path, params, labels_dir, cache_dir, frame_offset,
+                                                   iou_threshold, frames)
+                        group_of[follower] = key
+                        pending.add(follower)
+                print(f"{len(results)} configurations evaluated", end="\r", flush=True)
+    print()
+    return sorted(results, key=lambda result: result["ms_per_frame"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate ORBTracker settings against reference labels.")
+    parser.add_argument("video")
+    parser.add_argument("labels", help="directory of reference YOLO label files")
+    parser.add_argument("grid", help='JSON file of parameter lists, e.g. {"heatmap_size": [10, 20], "min_hits": [2, 3]}')
+    parser.add_argument("--workers", type=int, default=None, help="number of processes, every core by default")
+    parser.add_argument("--cache-dir", default="cache", help="keypoint cache shared by the configurations")
+    parser.add_argument("--frame-offset", type=int, default=-1, help="label file number minus the frame number")
+    parser.add_argument("--iou", type=float, default=0.5, help="minimum IoU of a true positive")
+    frames_group = parser.add_mutually_exclusive_group()
+    frames_group.add_argument("--frames", help="first:last frame evaluated, frames without a label file have no bees")
+    frames_group.add_argument("--frame-list", help="evaluate the images of a YOLO list such as train.txt, frames "
+                                                   "without a label file have no bees")
+    parser.add_argument("--min-precision", type=float, default=0.0)
+    parser.add_argument("--min-recall", type=float, default=0.0)
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args()
+    with open(args.grid) as f:
+        grid = json.load(f)
+    frames = None
+    if args.frames:
+        first, last = (int(v) for v in args.frames.split(":"))
+        frames = range(first, last + 1)
+    elif args.frame_list:
+        frames = read_frame_list(args.frame_list, args.frame_offset)
+    results = sweep(args.video, args.labels, grid, args.workers, args.cache_dir, args.frame_offset, args.iou, frames)
+    print(f"{'ms/frame':>9} {'precision':>9} {'recall':>7} {'f1':>6} {'id sw':>6}  params")
+    for result in results:
+        print(f"{result['ms_per_frame']:9.1f} {result['precision']:9.3f} {result['recall']:7.3f} {result['f1']:6.3f} "
+              f"{result['id_switches']:6d}  {json.dumps(result['params'])}")
+    eligible = [r for r in results if r["precision"] >= args.min_precision and r["recall"] >= args.min_recall]
+    best = eligible[0] if eligible else None
+    print("fastest configuration meeting the bar:", json.dumps(best["params"]) if best else "none")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"results": results, "best": best}, f, indent=2)
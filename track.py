@@ -1,57 +1,553 @@
+from functools import lru_cache
+
 import numpy as np
-from scipy.optimize import linear_sum_assignment
 
 
-class Track:
-    def __init__(self, track_id, bbox, frame_id):
-        self.track_id = track_id
-        self.bbox = bbox
-        self.frame_id = frame_id
-        self.tracked_positions = [bbox]
-        self.average_speed = 0
-        self.deleted = False
+ARCHIVE_DTYPE = np.dtype([("track_id", np.int64), ("first_frame", np.int64), ("last_frame", np.int64),
+                          ("length", np.int64), ("bbox", np.float32, 4), ("average_speed", np.float32)])
+
+
+def _hungarian(costs):
+    """
+    Solves a rectangular assignment problem with the shortest augmenting path Hungarian algorithm, in NumPy only.
+    Rows are added one at a time and the potentials keep the reduced costs non negative, every step of the search
+    updates all columns at once.
+    :param costs: (N, M) finite costs.
+    :return: matched row indices in increasing order and their column indices, min(N, M) pairs
+    """
+    costs = np.asarray(costs, float)
+    transposed = costs.shape[0] > costs.shape[1]
+    if transposed:
+        costs = costs.T
+    n_rows, n_cols = costs.shape
+    # 1 based, column 0 is the virtual start column of the row being added
+    u, v = np.zeros(n_rows + 1), np.zeros(n_cols + 1)
+    owner = np.zeros(n_cols + 1, int)
+    way = np.zeros(n_cols + 1, int)
+    for row in range(1, n_rows + 1):
+        owner[0] = row
+        column = 0
+        min_reduced = np.full(n_cols + 1, np.inf)
+        used = np.zeros(n_cols + 1, bool)
+        while owner[column] != 0:
+            used[column] = True
+            current = owner[column]
+            reduced = costs[current - 1] - u[current] - v[1:]
+            free = ~used[1:]
+            better = free & (reduced < min_reduced[1:])
+            min_reduced[1:][better] = reduced[better]
+            way[1:][better] = column
+            candidates = np.where(free, min_reduced[1:], np.inf)
+            next_column = int(np.argmin(candidates)) + 1
+            delta = candidates[next_column - 1]
+            u[owner[used]] += delta
+            v[used] -= delta
+            min_reduced[1:][free] -= delta
+            column = next_column
+        # flip the augmenting path
+        while column:
+            previous = way[column]
+            owner[column] = owner[previous]
+            column = previous
+    cols = np.flatnonzero(owner[1:])
+    rows = owner[1:][cols] - 1
+    if transposed:
+        rows, cols = cols, rows
+    order = np.argsort(rows)
+    return rows[order], cols[order]
+
+
+def _label_components(n_nodes: int, rows, cols):
+    """
+    Labels the connected components of an undirected graph in NumPy only, by hooking every edge to the smaller
+    label and pointer jumping until both ends of every edge agree.
+    :param n_nodes:
+    :param rows: first node of every edge.
+    :param cols: second node of every edge.
+    :return: number of components and the component of every node, numbered from 0
+    """
+    labels = np.arange(n_nodes)
+    while True:
+        low = np.minimum(labels[rows], labels[cols])
+        np.minimum.at(labels, rows, low)
+        np.minimum.at(labels, cols, low)
+        labels = labels[labels]
+        if np.array_equal(labels[rows], labels[cols]):
+            break
+    unique, labels = np.unique(labels, return_inverse=True)
+    return len(unique), labels
+
+
+@lru_cache(maxsize=None)
+def _scipy():
+    """
+    Imports the scipy solvers on first use, scipy doubles the import time of the capture entry points.
+    :return: linear_sum_assignment, coo_matrix and connected_components, None without scipy
+    """
+    try:
+        from scipy.optimize import linear_sum_assignment
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import connected_components
+    except ImportError:
+        return None
+    return linear_sum_assignment, coo_matrix, connected_components
+
+
+def linear_sum_assignment(costs):
+    """
+    Solves a rectangular assignment problem with scipy when it is installed and with _hungarian otherwise.
+    :param costs: (N, M) finite costs.
+    :return: matched row indices and column indices
+    """
+    if _scipy() is None:
+        return _hungarian(costs)
+    return _scipy()[0](costs)
+
+
+def connected_components(n_nodes: int, rows, cols):
+    """
+    Labels the connected components of an undirected graph given by its edges, with scipy when it is installed.
+    :param n_nodes:
+    :param rows: first node of every edge.
+    :param cols: second node of every edge.
+    :return: number of components and the component of every node
+    """
+    if _scipy() is None:
+        return _label_components(n_nodes, rows, cols)
+    _, coo_matrix, label = _scipy()
+    graph = coo_matrix((np.ones(len(rows)), (rows, cols)), shape=(n_nodes, n_nodes))
+    return label(graph, directed=False)
+
+
+class TrackArchive:
+    def __init__(self, capacity: int = 1024):
+        """
+        Creates a TrackArchive object, a compact table with one fixed size record per retired track.
+        :param capacity: initial number of records, the table doubles when it is full.
+        """
+        self.capacity = capacity
+        self.records = np.zeros(capacity, ARCHIVE_DTYPE)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, records):
+        """
+        Appends retired track records.
+        :param records: structured array of ARCHIVE_DTYPE.
+        :return:
+        """
+        if self.size + len(records) > len(self.records):
+            grown = np.zeros(max(2 * len(self.records), self.size + len(records)), ARCHIVE_DTYPE)
+            grown[:self.size] = self.records[:self.size]
+            self.records = grown
+        self.records[self.size:self.size + len(records)] = records
+        self.size += len(records)
+
+    def get_records(self):
+        """
+        Gets the archived records.
+        :return:
+        """
+        return self.records[:self.size]
+
+    def trim(self, max_records: int):
+        """
+        Drops the oldest records beyond max_records and releases the unused part of the table.
+        :param max_records:
+        :return: the dropped records
+        """
+        n_dropped = max(self.size - max_records, 0)
+        dropped = self.records[:n_dropped].copy()
+        kept = self.records[n_dropped:self.size]
+        self.records = np.zeros(max(self.capacity, 2 * len(kept)), ARCHIVE_DTYPE)
+        self.records[:len(kept)] = kept
+        self.size = len(kept)
+        return dropped
+
+
+class TrackStore:
+    def __init__(self, capacity: int = 64, history: int = 50):
+        """
+        Creates a TrackStore object. Active tracks live in preallocated slots, each keeping its last history
+        positions in a ring buffer, so memory and per-frame work scale with the live tracks only.
+        Retired tracks are summarised into a TrackArchive and their slots are reused.
+        :param capacity: initial number of slots, doubled when all of them are in use.
+        :param history: number of positions kept per track.
+        """
+        self.history = history
+        self.capacity = capacity
+        self.next_id = 0
+        self.archive = TrackArchive()
+        self._allocate(capacity)
+
+    def _allocate(self, capacity: int):
+        """
+        Allocates empty slot arrays.
+        :param capacity:
+        :return:
+        """
+        self.track_ids = np.full(capacity, -1, np.int64)
+        self.positions = np.zeros((capacity, self.history, 4), np.float32)  # x, y, w, h ring buffer
+        self.lengths = np.zeros(capacity, np.int64)  # number of observations, also the ring buffer write head
+        self.first_frames = np.zeros(capacity, np.int64)
+        self.last_frames = np.zeros(capacity, np.int64)
+        self.average_speeds = np.zeros(capacity, np.float32)
+        self.active = np.zeros(capacity, bool)
+        self.states = np.zeros((capacity, 4))  # motion model x, y, vx, vy
+        self.covariances = np.zeros((capacity, 4, 4))
+
+    def _grow(self, capacity: int):
+        """
+        Grows the slot arrays to the given capacity keeping the current slots.
+        :param capacity:
+        :return:
+        """
+        old = (self.track_ids, self.positions, self.lengths, self.first_frames, self.last_frames,
+               self.average_speeds, self.active, self.states, self.covariances)
+        self._allocate(capacity)
+        for new, current in zip((self.track_ids, self.positions, self.lengths, self.first_frames, self.last_frames,
+                                 self.average_speeds, self.active, self.states, self.covariances), old):
+            new[:len(current)] = current
+
+    def compact(self):
+        """
+        Moves the active tracks to the first slots and shrinks the slot arrays to twice the number of active
+        tracks, never below the initial capacity. Track ids and the archive are kept.
+        :return: previous slots of the active tracks, in their new slot order
+        """
+        slots = self.active_slots()
+        arrays = (self.track_ids, self.positions, self.lengths, self.first_frames, self.last_frames,
+                  self.average_speeds, self.active, self.states, self.covariances)
+        kept = [array[slots] for array in arrays]
+        self._allocate(max(self.capacity, 2 * len(slots)))
+        for new, current in zip((self.track_ids, self.positions, self.lengths, self.first_frames, self.last_frames,
+                                 self.average_speeds, self.active, self.states, self.covariances), kept):
+            new[:len(current)] = current
+        return slots
+
+    def __len__(self):
+        return int(np.count_nonzero(self.active))
+
+    def active_slots(self):
+        """
+        Gets the slots of the active tracks.
+        :return:
+        """
+        return np.flatnonzero(self.active)
+
+    def add(self, bboxes, frame_id):
+        """
+        Starts a new track for every bbox.
+        :param bboxes: (N, 4) array of x, y, w, h.
+        :param frame_id: current frame id
+        :return: slots of the new tracks
+        """
+        bboxes = np.asarray(bboxes, np.float32).reshape(-1, 4)
+        free = np.flatnonzero(~self.active)
+        if len(free) < len(bboxes):
+            capacity = len(self.active)
+            self._grow(max(2 * capacity, capacity + len(bboxes) - len(free)))
+            free = np.flatnonzero(~self.active)
+        slots = free[:len(bboxes)]
+        self.track_ids[slots] = np.arange(self.next_id, self.next_id + len(slots))
+        self.next_id += len(slots)
+        self.positions[slots, 0] = bboxes
+        self.lengths[slots] = 1
+        self.first_frames[slots] = frame_id
+        self.last_frames[slots] = frame_id
+        self.average_speeds[slots] = 0
+        self.active[slots] = True
+        return slots
+
+    def update(self, slots, bboxes, frame_id):
+        """
+        Appends the matched bboxes to their tracks.
+        :param slots: slots of the matched tracks.
+        :param bboxes: (N, 4) array of x, y, w, h.
+        :param frame_id: current frame id
+        :return:
+        """
+        bboxes = np.asarray(bboxes, np.float32).reshape(-1, 4)
+        previous = self.last_bboxes(slots)
+        self.positions[slots, self.lengths[slots] % self.history] = bboxes
+        self.lengths[slots] += 1
+        self.last_frames[slots] = frame_id
+        # running mean of the displacement between consecutive observations
+        displacement = np.linalg.norm(bboxes[:, :2] - previous[:, :2], axis=1)
+        self.average_speeds[slots] += (displacement - self.average_speeds[slots]) / (self.lengths[slots] - 1)
+
+    def last_bboxes(self, slots):
+        """
+        Gets the last bbox of every given slot.
+        :param slots:
+        :return: (N, 4) array of x, y, w, h
+        """
+        return self.positions[slots, (self.lengths[slots] - 1) % self.history]
+
+    def trail(self, slot):
+        """
+        Gets the kept positions of one track, oldest first.
+        :param slot:
+        :return: (N, 4) array of x, y, w, h
+        """
+        length = self.lengths[slot]
+        n = min(length, self.history)
+        return self.positions[slot, np.arange(length - n, length) % self.history]
+
+    def retire(self, slots):
+        """
+        Moves the given tracks to the archive and frees their slots.
+        :param slots:
+        :return:
+        """
+        if len(slots) == 0:
+            return
+        records = np.zeros(len(slots), ARCHIVE_DTYPE)
+        records["track_id"] = self.track_ids[slots]
+        records["first_frame"] = self.first_frames[slots]
+        records["last_frame"] = self.last_frames[slots]
+        records["length"] = self.lengths[slots]
+        records["bbox"] = self.last_bboxes(slots)
+        records["average_speed"] = self.average_speeds[slots]
+        self.archive.append(records)
+        self.active[slots] = False
+        self.track_ids[slots] = -1
+
+    def retire_stale(self, frame_id, max_age: int):
+        """
+        Retires the tracks that haven't been updated for more than max_age frames.
+        :param frame_id: current frame id
+        :param max_age:
+        :return:
+        """
+        self.retire(np.flatnonzero(self.active & (self.last_frames < frame_id - max_age)))
+
+
+class ConstantVelocityKalman:
+    def __init__(self, process_noise: float = 8.0, measurement_noise: float = 150.0, velocity_variance: float = 100.0):
+        """
+        Creates a ConstantVelocityKalman object. The state of a track is x, y, vx, vy and only x, y are measured.
+        All methods work on stacked (N, 4) states and (N, 4, 4) covariances so every track is filtered at once.
+        :param process_noise: variance of the random acceleration per frame.
+        :param measurement_noise: variance of the measured center point in pixels, heatmap blob centers jitter by
+            a heatmap cell and jump when two bees merge into one blob.
+        :param velocity_variance: initial variance of the unknown velocity of a new track.
+        """
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.velocity_variance = velocity_variance
+
+    def initiate(self, xy):
+        """
+        Creates states at rest at the measured center points.
+        :param xy: (N, 2) array of center points.
+        :return: (N, 4) states and (N, 4, 4) covariances
+        """
+        xy = np.asarray(xy, np.float64).reshape(-1, 2)
+        states = np.zeros((len(xy), 4))
+        states[:, :2] = xy
+        variances = [self.measurement_noise] * 2 + [self.velocity_variance] * 2
+        covariances = np.broadcast_to(np.diag(variances), (len(xy), 4, 4)).copy()
+        return states, covariances
+
+    def predict(self, states, covariances, dt: float = 1):
+        """
+        Moves the states dt frames forward.
+        :param states: (N, 4) states.
+        :param covariances: (N, 4, 4) covariances.
+        :param dt: number of frames since the last prediction.
+        :return: predicted states and covariances
+        """
+        transition = np.eye(4)
+        transition[[0, 1], [2, 3]] = dt
+        # discrete white noise acceleration, the position and velocity noise of one axis are correlated
+        noise = np.zeros((4, 4))
+        noise[[0, 1], [0, 1]] = dt ** 4 / 4
+        noise[[0, 1, 2, 3], [2, 3, 0, 1]] = dt ** 3 / 2
+        noise[[2, 3], [2, 3]] = dt ** 2
+        states = states @ transition.T
+        covariances = transition @ covariances @ transition.T + self.process_noise * noise
+        return states, covariances
+
+    def innovation_covariance(self, covariances):
+        """
+        Gets the covariance of the measured center points around the states.
+        :param covariances: (N, 4, 4) covariances.
+        :return: (N, 2, 2) covariances
+        """
+        return covariances[:, :2, :2] + self.measurement_noise * np.eye(2)
+
+    def update(self, states, covariances, xy):
+        """
+        Corrects the states with the measured center points.
+        :param states: (N, 4) states.
+        :param covariances: (N, 4, 4) covariances.
+        :param xy: (N, 2) array of measured center points.
+        :return: corrected states and covariances
+        """
+        innovation = np.asarray(xy, np.float64).reshape(-1, 2) - states[:, :2]
+        innovation_covariance = self.innovation_covariance(covariances)
+        gain = covariances[:, :, :2] @ np.linalg.inv(innovation_covariance)
+        states = states + (gain @ innovation[:, :, None])[:, :, 0]
+        covariances = covariances - gain @ covariances[:, :2, :]
+        return states, covariances
 
-    def update(self, bbox, frame_id):
-        self.tracked_positions.append(bbox)
-        self.frame_id = frame_id
-        self.bbox = bbox
-        self.average_speed = self.average_speed + np.linalg.norm(bbox[:2] - self.tracked_positions[-2][:2])
-        self.average_speed = self.average_speed / len(self.tracked_positions)
 
 class HungarianTracker:
-    def __init__(self, n_history: int = 50):
+    def __init__(self, n_history: int = 50, max_distance: float = 50, trail_length: int = 50,
+                 motion_model: bool = False, gate_threshold: float = 4.0, max_speed: float = 30):
+        """
+        Creates a HungarianTracker object. Without a motion model the prediction of a track is its last position.
+        With motion_model the active tracks are filtered by a batched constant velocity Kalman filter, the
+        predicted positions are matched instead, see score.
+        :param n_history: number of frames a track is kept alive without a matching detection.
+        :param max_distance: gating distance in pixels between a prediction and a detection without a motion model.
+        :param trail_length: number of positions kept per track.
+        :param motion_model: whether to predict the tracks with a constant velocity Kalman filter.
+        :param gate_threshold: gating Mahalanobis distance with the motion model, 4 keeps all but 0.03 % of the
+            matches of a 2 dimensional Gaussian.
+        :param max_speed: pixels per frame since the last match a track may move with the motion model, it caps the
+            covariance of the tracks that coast for many frames.
+        """
         self.detections = []
         self.predictions = []
-        self.tracks = []
+        self.prediction_slots = np.empty(0, int)
+        self.detection_ids = np.empty(0, np.int64)
+        self.tracks = TrackStore(history=trail_length)
         self.n_history = n_history
+        self.max_distance = max_distance
+        self.kalman = ConstantVelocityKalman() if motion_model else None
+        self.gate_threshold = gate_threshold
+        self.max_speed = max_speed
+        self.model_frame = None
 
     def get_assignments(self):
         """
-            hungarian algorithm to match current and previous center points
-            :param detections:
-            :param predictions:
-            :return:
+            hungarian algorithm to match current and previous center points.
+            the distances are computed in one broadcast and gated before solving. the gated pairs form a bipartite
+            graph whose connected components are independent assignment problems. components with one prediction
+            and one detection are matched directly, the others are solved with a rectangular linear_sum_assignment.
+            :return: indices of the matched predictions, indices of the matched detections and their distances
             """
-        # create cost matrix of current and previous center points which is square matrix
-        shape = np.max([len(self.detections), len(self.predictions)])
-        cost_matrix = np.full((shape, shape), 999999)
-
-        detections, predictions = np.array(self.detections), np.array(self.predictions)
-        for i, p in enumerate(predictions):
-            for j, d in enumerate(detections):
-                cost_matrix[i, j] = np.linalg.norm(d[:2] - p[:2])
-        # solve assignment problem
-        row_ind, col_ind = linear_sum_assignment(cost_matrix)
-        return col_ind, cost_matrix[row_ind, col_ind]
+        predictions = np.asarray(self.predictions, float).reshape(-1, 5)
+        detections = np.asarray(self.detections, float).reshape(-1, 4)
+        n_predictions, n_detections = len(predictions), len(detections)
+        distances = np.linalg.norm(predictions[:, None, :2] - detections[None, :, :2], axis=2)
+        cost_matrix, gate = self.score(predictions, detections, distances)
+        rows, cols = np.nonzero(gate)
+        if len(rows) == 0:
+            return np.empty(0, int), np.empty(0, int), np.empty(0)
+        # predictions are nodes [0, n_predictions), detections follow them
+        _, labels = connected_components(n_predictions + n_detections, rows, cols + n_predictions)
+        edge_labels = labels[rows]
+        n_labels = labels.max() + 1
+        row_counts = np.bincount(labels[:n_predictions], minlength=n_labels)
+        col_counts = np.bincount(labels[n_predictions:], minlength=n_labels)
+        trivial = (row_counts == 1) & (col_counts == 1)
+        single = trivial[edge_labels]
+        matched_rows, matched_cols = [rows[single]], [cols[single]]
+        for label in np.unique(edge_labels[~single]):
+            component_rows = np.flatnonzero(labels[:n_predictions] == label)
+            component_cols = np.flatnonzero(labels[n_predictions:] == label)
+            component = np.ix_(component_rows, component_cols)
+            costs, gated = cost_matrix[component], gate[component]
+            # gated pairs can't be forbidden outright, any value above every gated cost keeps them last
+            costs = np.where(gated, costs, costs[gated].max() * (len(costs) + 1) + 1)
+            row_ind, col_ind = linear_sum_assignment(costs)
+            keep = gated[row_ind, col_ind]
+            matched_rows.append(component_rows[row_ind[keep]])
+            matched_cols.append(component_cols[col_ind[keep]])
+        matched_rows, matched_cols = np.concatenate(matched_rows), np.concatenate(matched_cols)
+        return matched_rows, matched_cols, distances[matched_rows, matched_cols]
 
-    def get_last_bboxes(self, frame_id):
+    def score(self, predictions, detections, distances):
+        """
+            costs of matching predictions and detections and the pairs that may be matched at all.
+            without a motion model the cost is the distance and the pairs closer than max_distance pixels are gated.
+            with a motion model the cost is the negative log likelihood of the detection under the track's
+            innovation covariance, squared Mahalanobis distance plus log determinant, so an uncertain track can't
+            take the detections of a settled one. pairs are gated within gate_threshold Mahalanobis distance and
+            max_speed pixels per frame since the track's last match.
+            :param predictions: (N, 5) array of x, y, w, h, track id
+            :param detections: (M, 4) array of x, y, w, h
+            :param distances: (N, M) distances between the center points in pixels
+            :return: (N, M) non negative costs and (N, M) boolean array
+        """
+        if self.kalman is None:
+            return distances, distances < self.max_distance
+        elapsed = self.model_frame - self.tracks.last_frames[self.prediction_slots]
+        gate = distances < self.max_speed * np.maximum(elapsed, 1)[:, None]
+        innovation = detections[None, :, :2] - predictions[:, None, :2]
+        covariances = self.kalman.innovation_covariance(self.tracks.covariances[self.prediction_slots])
+        squared = np.einsum("nmi,nij,nmj->nm", innovation, np.linalg.inv(covariances), innovation)
+        # the innovation covariance is at least the measurement noise, relative to it the log determinant is >= 0
+        log_det = np.log(np.linalg.det(covariances) / self.kalman.measurement_noise ** 2)
+        return squared + log_det[:, None], gate & (squared < self.gate_threshold ** 2)
+
+    def predict(self, frame_id):
+        """
+            move the motion model of all active tracks forward to frame_id
+            :param frame_id: current frame id
+            :return:
         """
-            get last bboxes of all tracks up to n_history frames
-            :param tracks:
+        if self.kalman is None:
+            return
+        if self.model_frame is not None and frame_id > self.model_frame:
+            slots = self.tracks.active_slots()
+            self.tracks.states[slots], self.tracks.covariances[slots] = self.kalman.predict(
+                self.tracks.states[slots], self.tracks.covariances[slots], frame_id - self.model_frame)
+        self.model_frame = frame_id
+
+    def compact(self, frame_id):
+        """
+            retire the stale tracks and shrink the track store to the active tracks.
+            called between frames, the active tracks, their motion model and the track ids are kept.
+            :param frame_id: current frame id
             :return:
         """
-        return [np.hstack([track.tracked_positions[-1], track.track_id]) for track in self.tracks
-                if track.frame_id >= frame_id - self.n_history and not track.deleted]
+        self.tracks.retire_stale(frame_id, self.n_history)
+        self.tracks.compact()
+        self.prediction_slots = np.empty(0, int)
+
+    def propagate(self, frame_id):
+        """
+            move the tracks of the last detections to frame_id without detecting, for the frames between two
+            detections. with a motion model the center points are the predicted ones, otherwise the last ones.
+            tracks retired since the detections are dropped.
+            :param frame_id: current frame id
+            :return: (N, 4) array of x, y, w, h of the tracks in detection_ids
+        """
+        self.predict(frame_id)
+        slots = self.tracks.active_slots()
+        order = np.argsort(self.tracks.track_ids[slots])
+        slots = slots[order]
+        index = np.searchsorted(self.tracks.track_ids[slots], self.detection_ids)
+        index = np.minimum(index, max(len(slots) - 1, 0))
+        found = (self.tracks.track_ids[slots[index]] == self.detection_ids) if len(slots) else \
+            np.zeros(len(self.detection_ids), bool)
+        slots = slots[index[found]]
+        self.detection_ids = self.detection_ids[found]
+        bboxes = self.tracks.last_bboxes(slots)
+        if self.kalman is not None:
+            bboxes[:, :2] = self.tracks.states[slots, :2]
+        return bboxes
+
+    def get_last_bboxes(self, frame_id):
+        """
+            retire the tracks older than n_history frames and get the last bboxes of the remaining ones.
+            with a motion model the center points are the predicted ones.
+            :param frame_id: current frame id
+            :return: (N, 5) array of x, y, w, h, track id
+        """
+        self.tracks.retire_stale(frame_id, self.n_history)
+        self.predict(frame_id)
+        self.prediction_slots = self.tracks.active_slots()
+        bboxes = self.tracks.last_bboxes(self.prediction_slots)
+        if self.kalman is not None:
+            bboxes[:, :2] = self.tracks.states[self.prediction_slots, :2]
+        return np.column_stack([bboxes, self.tracks.track_ids[self.prediction_slots]])
 
     def get_tracks(self, detections, frame_id):
         """
@@ -74,24 +570,22 @@ class HungarianTracker:
             :param frame_id: current frame id
             :return:
             """
-        # associate detections and predictions
-
-        if len(self.tracks) <= 0:
-            for i, d in enumerate(self.detections):
-                self.tracks.append(Track(i, np.array([d[0], d[1], d[2], d[3]]), frame_id))  # track id, x, y, w, h
-            return self.tracks
-        assignments, costs = self.get_assignments()
-        # add unassociated center points
-        assigned = []
-        for i, a in enumerate(assignments):
-            if a < len(self.detections) and i < len(self.tracks) and costs[i] < 50:
-                # if detection is associated, add it to track
-                self.tracks[int(self.predictions[i][4])].update(self.detections[a], frame_id)
-                assigned.append(a)
-            else:
-                continue
+        detections = np.asarray(self.detections, np.float32).reshape(-1, 4)
+        rows, cols, _ = self.get_assignments()
+        # if detection is associated, add it to track
+        slots = self.prediction_slots[rows]
+        self.tracks.update(slots, detections[cols], frame_id)
         # add missing center points
-        for i, d in enumerate(self.detections):
-            if i not in assigned:
-                self.tracks.append(Track(len(self.tracks), d, frame_id))
-        return self.tracks
\ No newline at end of file
+        assigned = np.zeros(len(detections), bool)
+        assigned[cols] = True
+        new_slots = self.tracks.add(detections[~assigned], frame_id)
+        # track id of every detection, in detection order
+        self.detection_ids = np.empty(len(detections), np.int64)
+        self.detection_ids[cols] = self.tracks.track_ids[slots]
+        self.detection_ids[~assigned] = self.tracks.track_ids[new_slots]
+        if self.kalman is not None:
+            self.tracks.states[slots], self.tracks.covariances[slots] = self.kalman.update(
+                self.tracks.states[slots], self.tracks.covariances[slots], detections[cols, :2])
+            self.tracks.states[new_slots], self.tracks.covariances[new_slots] = self.kalman.initiate(
+                detections[~assigned, :2])
+        return self.tracks
@@ -1,8 +1,11 @@
-import datetime
-from threading import Thread
+import queue
+import time
+from threading import Thread, current_thread
 
 import cv2
 
+from metrics import metrics
+
 
 class FPS:
     def __init__(self):
@@ -15,23 +18,23 @@ class FPS:
 
     def start(self):
         # start the timer
-        self._start = datetime.datetime.now()
+        self._start = time.perf_counter()
         return self
 
     def stop(self):
         # stop the timer
-        self._end = datetime.datetime.now()
+        self._end = time.perf_counter()
 
     def update(self):
         # increment the total number of frames examined during the
         # start and end intervals
         self._numFrames += 1
-        self._now = datetime.datetime.now()
+        self._now = time.perf_counter()
 
     def elapsed(self):
         # return the total number of seconds between the start and
         # end interval
-        return (self._now - self._start).total_seconds()
+        return self._now - self._start
 
     def fps(self):
         # compute the (approximate) frames per second
@@ -39,33 +42,92 @@ class FPS:
 
 
 class WebcamVideoStream:
-    def __init__(self, src=0):
-        # initialize the video camera stream and read the first frame
-        # from the stream
-        self.stream = cv2.VideoCapture(src)
-        (self.grabbed, self.frame) = self.stream.read()
+    def __init__(self, src=0, queue_size: int = 0, drop_oldest: bool = True):
+        # initialize the video camera stream, src is a source for cv2.VideoCapture or an opened capture.
+        # with queue_size 0 read returns the frame most recently read. otherwise frames are passed through
+        # a bounded queue; when it is full drop_oldest discards the oldest frame (live cameras) instead of
+        # blocking the reader (files, where every frame has to be processed)
+        self.stream = src if isinstance(src, cv2.VideoCapture) else cv2.VideoCapture(src)
+        self.frames = queue.Queue(maxsize=queue_size) if queue_size > 0 else None
+        self.drop_oldest = drop_oldest
+        self.grabbed, self.frame = False, None
+        if self.frames is None:
+            # read the first frame so read never returns an empty frame
+            (self.grabbed, self.frame) = self.stream.read()
         # initialize the variable used to indicate if the thread should
         # be stopped
         self.stopped = False
+        self.thread = None
 
     def start(self):
-        # start the thread to read frames from the video stream
-        Thread(target=self.update, args=()).start()
+        # start the daemon thread to read frames from the video stream
+        self.thread = Thread(target=self.update, args=(), daemon=True)
+        self.thread.start()
         return self
 
     def update(self):
         # keep looping infinitely until the thread is stopped
-        while True:
-            # if the thread indicator variable is set, stop the thread
-            if self.stopped:
-                return
+        while not self.stopped:
             # otherwise, read the next frame from the stream
-            (self.grabbed, self.frame) = self.stream.read()
+            grabbed, frame = self.stream.read()
+            if self.frames is None:
+                (self.grabbed, self.frame) = grabbed, frame
+                continue
+            self._put((grabbed, frame))
+            if not grabbed:
+                # end of the stream, read returns the failed grab once the queue is drained
+                return
+
+    def _put(self, item):
+        # queue a frame following the drop or block policy
+        while not self.stopped:
+            try:
+                if self.drop_oldest:
+                    self.frames.put_nowait(item)
+                else:
+                    self.frames.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                if self.drop_oldest:
+                    try:
+                        self.frames.get_nowait()
+                        metrics.increment("dropped_frames")
+                    except queue.Empty:
+                        pass
 
     def read(self):
-        # return the frame most recently read
-        return self.grabbed, self.frame
+        # return the frame most recently read or the next queued frame
+        if self.frames is None:
+            return self.grabbed, self.frame
+        while True:
+            try:
+                return self.frames.get(timeout=0.1)
+            except queue.Empty:
+                if self.stopped or self.thread is None or not self.thread.is_alive():
+                    return False, None
+
+    def skip(self, n_frames: int):
+        # drop up to n_frames queued frames without waiting for new ones, returns the number dropped
+        dropped = 0
+        while self.frames is not None and dropped < n_frames:
+            try:
+                grabbed, _ = self.frames.get_nowait()
+            except queue.Empty:
+                break
+            if not grabbed:
+                # keep the end of the stream for read
+                self.frames.put((grabbed, None))
+                break
+            dropped += 1
+        return dropped
+
+    def pending(self):
+        # number of frames waiting in the queue
+        return 0 if self.frames is None else self.frames.qsize()
 
     def release(self):
-        # indicate that the thread should be stopped
+        # indicate that the thread should be stopped, wait for it and release the stream
         self.stopped = True
+        if self.thread is not None and self.thread is not current_thread():
+            self.thread.join()
+        self.stream.release()